@@ -0,0 +1,87 @@
+import argparse
+import copy
+import time
+
+import torch
+
+from metrics import bivariate_loss
+from model import SGTN
+from utils import cpu_autocast
+
+
+def make_scenes(num_scenes, obs_seq_len, pred_seq_len, num_person, seed=0):
+    """
+    Random scenes shaped like the train_b.py batches: V_obs [1, 2, 8, num_person], A_obs [8, num_person, num_person],
+    V_tr [12, num_person, 2].
+    """
+    generator = torch.Generator().manual_seed(seed)
+    scenes = []
+    for _ in range(num_scenes):
+        V_obs = torch.randn(1, 2, obs_seq_len, num_person, generator=generator) * 0.1
+        A_obs = torch.rand(obs_seq_len, num_person, num_person, generator=generator)
+        V_tr = torch.randn(pred_seq_len, num_person, 2, generator=generator) * 0.1
+        scenes.append((V_obs, A_obs, V_tr))
+    return scenes
+
+
+def train_steps(model, scenes, bf16, lr=1e-3):
+    """
+    One pass of teacher forced training over scenes, returns (per-step losses, seconds).
+    """
+    model.train()
+    optimizer = torch.optim.Adam(model.parameters(), lr=lr)
+    losses = []
+    time_start = time.time()
+    for V_obs, A_obs, V_tr in scenes:
+        optimizer.zero_grad()
+        V_tr_tmp = torch.cat((V_obs[:, :, -1:, :], V_tr.permute(2, 0, 1).unsqueeze(0)[:, :, 1:, :]), dim=2) # [1, 2, 12, num_person]
+        with cpu_autocast(bf16):
+            V_pred, _ = model(V_obs, A_obs, V_tr_tmp)
+        loss = bivariate_loss(V_pred.float().permute(0, 2, 3, 1).squeeze(0), V_tr)
+        loss.backward()
+        optimizer.step()
+        losses.append(loss.item())
+    return losses, time.time() - time_start
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--n_sstgcn', type=int, default=3)
+    parser.add_argument('--n_txpcnn', type=int, default=5)
+    parser.add_argument('--output_size', type=int, default=5)
+    parser.add_argument('--kernel_size', type=int, default=3)
+    parser.add_argument('--obs_seq_len', type=int, default=8)
+    parser.add_argument('--pred_seq_len', type=int, default=12)
+    parser.add_argument('--emb_size', type=int, default=32)
+    parser.add_argument('--heads', type=int, default=4)
+    parser.add_argument('--layers', type=int, default=6)
+    parser.add_argument('--fw', type=int, default=128)
+    parser.add_argument('--num_person', type=int, default=64)
+    parser.add_argument('--steps', type=int, default=50)
+    parser.add_argument('--warmup', type=int, default=3)
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    torch.manual_seed(args.seed)
+    model = SGTN(n_sstgcn=args.n_sstgcn, n_txpcnn=args.n_txpcnn, output_feat=args.output_size,
+                 seq_len=args.obs_seq_len, pred_seq_len=args.pred_seq_len, kernel_size=args.kernel_size,
+                 emb_size=args.emb_size, fw=args.fw, heads=args.heads, layers=args.layers)
+    scenes = make_scenes(args.steps, args.obs_seq_len, args.pred_seq_len, args.num_person, args.seed)
+    warmup = make_scenes(args.warmup, args.obs_seq_len, args.pred_seq_len, args.num_person, args.seed + 1)
+
+    results = {}
+    for name, bf16 in [('fp32', False), ('bf16', True)]:
+        train_steps(copy.deepcopy(model), warmup, bf16)
+        torch.manual_seed(args.seed) # same dropout draws for both runs
+        results[name] = train_steps(copy.deepcopy(model), scenes, bf16)
+
+    losses_32, time_32 = results['fp32']
+    losses_16, time_16 = results['bf16']
+    print('CPU training, {:d} agents, {:d} steps'.format(args.num_person, args.steps))
+    print('  fp32 : {:.2f} steps/s'.format(args.steps / time_32))
+    print('  bf16 : {:.2f} steps/s ({:.2f}x)'.format(args.steps / time_16, time_32 / time_16))
+    print('Loss curve (fp32 / bf16):')
+    for i in range(0, args.steps, max(1, args.steps // 10)):
+        print('  step {:3d}: {:.4f} / {:.4f}'.format(i, losses_32[i], losses_16[i]))
+    diff = [abs(a - b) for a, b in zip(losses_32, losses_16)]
+    print('Max abs loss difference: {:.4f}, final: {:.4f} / {:.4f}'.format(max(diff), losses_32[-1], losses_16[-1]))
@@ -0,0 +1,250 @@
+import concurrent.futures
+import multiprocessing
+import os
+import logging
+
+import numpy as np
+import torch
+import torch.multiprocessing
+
+from metrics import EvalAccumulator, MultiKAccumulator, CollisionAccumulator, seq_to_nodes_torch, nodes_rel_to_nodes_abs_torch
+from utils import evaluate_ksteps, compute_col_batch
+
+
+def _evaluate_chunk(chunk, compute_col_truth, ks=None, exact_col=False, thres=0.2, num_interp=4):
+    # runs in a worker, the tensors arrive as shared memory handles and are read in place
+    return [evaluate_ksteps(pred.numpy(), target.numpy(), mask.numpy(), compute_col_truth, ks, exact_col, thres, num_interp)
+            for pred, target, mask in chunk]
+
+
+def _flatten(arrays):
+    # one flat buffer for a list of tensors of different shapes, _views() gives them back
+    return torch.cat([array.detach().reshape(-1) for array in arrays]).cpu(), [tuple(array.shape) for array in arrays]
+
+
+def _views(buffer, shapes):
+    views = []
+    offset = 0
+    for shape in shapes:
+        size = int(np.prod(shape))
+        views.append(buffer[offset:offset + size].view(shape))
+        offset += size
+    return views
+
+
+def _pack(arrays):
+    # every shared storage holds an open file descriptor until it is freed, so the arrays of one submit
+    # share a single buffer. Tensors already in shared memory (EvalContext) are passed on as they are
+    if all(torch.is_tensor(array) and array.is_shared() for array in arrays):
+        return list(arrays)
+    buffer, shapes = _flatten([array if torch.is_tensor(array) else torch.from_numpy(array) for array in arrays])
+    return _views(buffer.share_memory_(), shapes)
+
+
+def _to_numpy(array):
+    return array.detach().cpu().numpy() if torch.is_tensor(array) else array
+
+
+class PendingEval(object):
+    """
+    Handle for the metrics of one submitted epoch, result() blocks and returns the evaluate_ksteps tuples in batch order.
+    """
+
+    def __init__(self, futures):
+        self.futures = futures
+
+    def done(self):
+        return all(future.done() for future in self.futures)
+
+    def result(self):
+        results = []
+        for future in self.futures:
+            results += future.result()
+        return results
+
+
+class EvalStream(object):
+    """
+    Per batch feed into an EvalExecutor. Batches are submitted in chunks and finished chunks are folded into an
+    EvalAccumulator right away, so host memory is bounded by the chunks still in flight, not by the epoch.
+    """
+
+    def __init__(self, executor, compute_col_truth=False, chunk=16, truth=None, ks=None, exact_col=False, thres=0.2,
+                 num_interp=4):
+        self.executor = executor
+        # with precomputed truth curves the workers skip the ground-truth collision check
+        self.compute_col_truth = compute_col_truth and truth is None
+        self.chunk = chunk
+        # ks: best-of-K values reported from prefixes of the same samples, see MultiKAccumulator
+        self.ks = ks
+        # collision settings, those of the EvalContext when its truth curves are used
+        self.exact_col = exact_col
+        self.thres = thres
+        self.num_interp = num_interp
+        if ks is None:
+            self.accumulator = EvalAccumulator(compute_col_truth, truth if compute_col_truth else None, num_interp)
+        else:
+            self.accumulator = MultiKAccumulator(ks, compute_col_truth, truth if compute_col_truth else None, num_interp)
+        self.buffer = []
+        self.pending = []
+
+    def add(self, pred, target, mask):
+        # pred: [KSTEPS, 12, num_object, 2]  target: [12, num_object, 2]  mask: [num_object, num_object]
+        self.buffer.append((pred, target, mask))
+        if len(self.buffer) >= self.chunk:
+            self.flush()
+
+    def flush(self):
+        if self.buffer:
+            preds, targets, masks = zip(*self.buffer)
+            self.pending.append(self.executor.submit(preds, targets, masks, self.compute_col_truth, self.ks, self.exact_col,
+                                                     self.thres, self.num_interp))
+            self.buffer = []
+        self.collect()
+
+    def collect(self, block=False):
+        # fold finished chunks in submission order
+        while self.pending and (block or self.pending[0].done()):
+            for result in self.pending.pop(0).result():
+                self.accumulator.update(result)
+
+    def done(self):
+        return not self.buffer and all(pending.done() for pending in self.pending)
+
+    def result(self):
+        self.flush()
+        self.collect(block=True)
+        return self.accumulator
+
+
+def default_workers():
+    # every spawned worker is a full interpreter importing torch (a few hundred MB each), a handful is enough
+    # to keep up with the training loop
+    return min(multiprocessing.cpu_count(), 4)
+
+
+class EvalExecutor(object):
+    """
+    Long-lived pool for the ADE/FDE/collision evaluation, created once per run.
+    The predictions, ground truth and neighbor masks of each submit are packed into one shared buffer per kind,
+    the workers only receive handles. submit() returns right away so metrics of one epoch can be computed while the next one trains.
+    workers=0 evaluates in the calling process, None uses default_workers().
+    """
+
+    def __init__(self, workers=None, chunks_per_worker=4, start_method='spawn'):
+        self.workers = default_workers() if workers is None else workers
+        self.chunks_per_worker = chunks_per_worker
+        self.executor = None
+        if self.workers > 0:
+            self.executor = concurrent.futures.ProcessPoolExecutor(
+                max_workers=self.workers, mp_context=torch.multiprocessing.get_context(start_method))
+            # start the workers now, their imports then overlap with the first training epoch
+            for _ in range(self.workers):
+                self.executor.submit(int)
+
+    def submit(self, preds, targets, masks, compute_col_truth=False, ks=None, exact_col=False, thres=0.2, num_interp=4):
+        # preds: list of [KSTEPS, 12, num_object, 2]  targets: list of [12, num_object, 2]  masks: list of [num_object, num_object]
+        # numpy arrays or tensors, device tensors are copied to host shared memory here
+        items = list(zip(preds, targets, masks))
+        if self.executor is None:
+            future = concurrent.futures.Future()
+            future.set_result([evaluate_ksteps(_to_numpy(pred), _to_numpy(target), _to_numpy(mask), compute_col_truth, ks,
+                                               exact_col, thres, num_interp)
+                               for pred, target, mask in items])
+            return PendingEval([future])
+
+        items = list(zip(_pack(preds), _pack(targets), _pack(masks)))
+        chunk_size = max(1, -(-len(items) // (self.workers * self.chunks_per_worker)))
+        futures = [self.executor.submit(_evaluate_chunk, items[i:i + chunk_size], compute_col_truth, ks, exact_col, thres,
+                                        num_interp)
+                   for i in range(0, len(items), chunk_size)]
+        return PendingEval(futures)
+
+    def stream(self, compute_col_truth=False, chunk=16, truth=None, ks=None, exact_col=False, thres=0.2, num_interp=4):
+        return EvalStream(self, compute_col_truth, chunk, truth, ks, exact_col, thres, num_interp)
+
+    def shutdown(self):
+        if self.executor is not None:
+            self.executor.shutdown(wait=True)
+            self.executor = None
+
+
+def dataset_fingerprint(loader, cache_path=None):
+    # (name, size, mtime) of the files next to the dataset, the cache file itself left out
+    data_dir = getattr(loader.dataset, 'data_dir', None) if hasattr(loader, 'dataset') else None
+    if data_dir is None or not os.path.isdir(data_dir):
+        return []
+    skip = os.path.basename(cache_path) if cache_path is not None else None
+    fingerprint = []
+    for name in sorted(os.listdir(data_dir)):
+        path = os.path.join(data_dir, name)
+        if name == skip or name.startswith('eval_context') or not os.path.isfile(path):
+            continue
+        stat = os.stat(path)
+        fingerprint.append((name, stat.st_size, stat.st_mtime_ns))
+    return fingerprint
+
+
+class EvalContext(object):
+    """
+    Ground-truth side of the evaluation of one (unshuffled) loader, computed once and reused every epoch:
+    last observed positions, absolute ground-truth futures, neighbor masks and the ground-truth collision curves.
+    Targets and masks are kept in one flat buffer each; with share=True (evaluation workers) the two buffers are
+    moved to shared memory once, so only the predictions are copied for the workers each epoch.
+    col_args holds the collision settings to pass to EvalExecutor.stream along with the truth curves.
+    With cache_path set the context is stored there and loaded on the next run, as long as the collision
+    settings and the dataset files (names, sizes, mtimes) are those it was built with; otherwise it is rebuilt.
+    """
+
+    def __init__(self, loader, device, cache_path=None, exact_col=False, thres=0.2, num_interp=4, share=False):
+        key = {'num_batch': len(loader), 'exact_col': exact_col, 'thres': thres, 'num_interp': num_interp,
+               'dataset': dataset_fingerprint(loader, cache_path)}
+        data = None
+        if cache_path is not None and os.path.exists(cache_path):
+            data = torch.load(cache_path)
+            # contexts saved before the flat buffers have no target_buffer, rebuild those as well
+            if data.get('key') == key and 'target_buffer' in data:
+                logging.info('Loaded evaluation context at {:s}.'.format(cache_path))
+            else:
+                logging.warning('Evaluation context at {:s} is stale, rebuilding it.'.format(cache_path))
+                data = None
+        if data is None:
+            data = self.build(loader, exact_col, thres, num_interp)
+            data['key'] = key
+            if cache_path is not None:
+                torch.save(data, cache_path)
+                logging.info('Saved evaluation context at {:s}.'.format(cache_path))
+
+        self.col_args = {'exact_col': exact_col, 'thres': thres, 'num_interp': num_interp}
+        self.starts = [start.to(device) for start in data['starts']] # [num_person, 2]
+        if share:
+            data['target_buffer'].share_memory_()
+            data['mask_buffer'].share_memory_()
+        self.targets = _views(data['target_buffer'], data['target_shapes']) # [12, num_person, 2]
+        self.masks = _views(data['mask_buffer'], data['mask_shapes']) # [num_person, num_person]
+        self.truth = CollisionAccumulator(num_interp)
+        self.truth.count = data['truth_count']
+        self.truth.step_sum = data['truth_step_sum'].numpy()
+        self.truth.cum_sum = data['truth_cum_sum'].numpy()
+
+    @staticmethod
+    def build(loader, exact_col=False, thres=0.2, num_interp=4):
+        starts, targets, masks = [], [], []
+        truth = CollisionAccumulator(num_interp)
+        for batch in loader:
+            obs_traj, pred_traj_gt, obs_traj_rel, pred_traj_gt_rel, non_linear_ped, \
+            loss_mask, V_obs, A_obs, V_tr, A_tr = batch
+            num_of_objs = obs_traj_rel.shape[1]
+            start = seq_to_nodes_torch(obs_traj.float())[-1] # [num_person, 2]
+            target = nodes_rel_to_nodes_abs_torch(V_tr.float()[0, :, :num_of_objs], start) # [12, num_person, 2]
+            mask = A_obs[0, 1] != 0 # same neighbors as A_obs_tmp[1] in the eval loops
+            target_trajs = target.numpy().transpose(1, 0, 2)[None] # [1, num_person, 12, 2]
+            truth.update(compute_col_batch(target_trajs, target_trajs, mask.numpy(), thres, num_interp, exact_col)[0])
+            starts.append(start)
+            targets.append(target)
+            masks.append(mask)
+        target_buffer, target_shapes = _flatten(targets)
+        mask_buffer, mask_shapes = _flatten(masks)
+        return {'num_batch': len(starts), 'starts': starts, 'target_buffer': target_buffer, 'target_shapes': target_shapes,
+                'mask_buffer': mask_buffer, 'mask_shapes': mask_shapes, 'truth_count': truth.count, 'truth_step_sum': torch.as_tensor(truth.step_sum),
+                'truth_cum_sum': torch.as_tensor(truth.cum_sum)}
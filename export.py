@@ -0,0 +1,182 @@
+import argparse
+import time
+
+import torch
+import torch.nn as nn
+
+from model import SGTN
+from transformer.functional import cached_src_mask
+
+
+# Parts of the eager SGTN that torch.jit.script cannot compile. The export below traces the encoder and one
+# decoder graph per prefix length around them and only scripts the autoregressive loop.
+UNSUPPORTED = [
+    'SublayerConnection receives its sublayer as a Python callable (lambdas in EncoderLayer/DecoderLayer)',
+    'MultiHeadAttention stores the attention kernel as a plain Python function attribute',
+    'cached_subsequent_mask/cached_src_mask keep masks in a Python dict keyed by device',
+    'PositionalEncoding wraps its buffer in torch.autograd.Variable',
+]
+
+# Features the exported module does not cover, use the eager model for them.
+EAGER_ONLY = [
+    'return_feat (contrastive features) and training',
+    'ground-truth guided decoding (train_b.sample_pred / train.sample_pred)',
+    'prediction horizons longer than the one given at export time',
+]
+
+
+class EncoderExport(nn.Module):
+    def __init__(self, model):
+        super(EncoderExport, self).__init__()
+        self.model = model
+
+    def forward(self, v, a):
+        memory, _, _ = self.model.encode(v, a)
+        return memory # bs*num,8,emb_size
+
+
+class DecoderStepExport(nn.Module):
+    def __init__(self, model):
+        super(DecoderStepExport, self).__init__()
+        self.model = model
+
+    def forward(self, memory, v_t):
+        src_att = cached_src_mask(memory.size(1), memory.device)
+        return self.model.decode_step(memory, src_att, v_t) # [ksteps, 5, T, num_person]
+
+
+class ScriptedRollout(nn.Module):
+    """
+    Autoregressive decoding loop of SGTN.rollout over traced encoder/decoder graphs.
+    """
+
+    def __init__(self, encoder, decoders):
+        super(ScriptedRollout, self).__init__()
+        self.encoder = encoder
+        self.decoders = nn.ModuleList(decoders)
+
+    def forward(self, v, a, ksteps: int = 1, sample: bool = True):
+        # [1, 2, 8, num_person]  # [8, num_person, num_person] -> [ksteps, pred_seq_len, num_person, 2]
+        memory = self.encoder(v, a).repeat(ksteps, 1, 1)
+        v_t = v[:, :, -1:, :].repeat(ksteps, 1, 1, 1)
+
+        for decoder in self.decoders:
+            V_step = decoder(memory, v_t)[:, :, -1, :] # [ksteps, 5, num_person]
+            output = V_step[:, 0:2]
+            if sample:
+                # analytic cholesky factor of the 2x2 covariance
+                sx = torch.exp(V_step[:, 2])
+                sy = torch.exp(V_step[:, 3])
+                corr = torch.tanh(V_step[:, 4])
+                noise = torch.randn_like(output)
+                dx = sx * noise[:, 0]
+                dy = sy * (corr * noise[:, 0] + torch.sqrt(1 - corr * corr) * noise[:, 1])
+                output = output + torch.stack((dx, dy), dim=1)
+            v_t = torch.cat((v_t, output.unsqueeze(2)), 2)
+
+        return v_t[:, :, 1:, :].permute(0, 2, 3, 1)
+
+
+def export_torchscript(model, v, a, pred_seq_len):
+    """
+    Trace the encoder and one decoder graph per prefix length on example inputs, then script the loop.
+    The agent count stays dynamic, the observation and prediction lengths are fixed.
+    """
+    model.eval()
+    with torch.no_grad():
+        encoder = torch.jit.trace(EncoderExport(model), (v, a))
+        memory = encoder(v, a)
+        decoders = []
+        v_t = v[:, :, -1:, :]
+        for i in range(pred_seq_len):
+            decoders.append(torch.jit.trace(DecoderStepExport(model), (memory, v_t)))
+            v_t = torch.cat((v_t, v[:, :, -1:, :]), 2)
+    return torch.jit.script(ScriptedRollout(encoder, decoders))
+
+
+def compile_model(model):
+    """
+    torch.compile the eager rollout, requirements.txt pins torch>=2.0.
+    """
+    return torch.compile(model.rollout)
+
+
+def mean_rollout(model, v, a, pred_seq_len):
+    """
+    Eager reference for ScriptedRollout(sample=False): feed back the predicted means.
+    """
+    memory, src_att, _ = model.encode(v, a)
+    v_t = v[:, :, -1:, :]
+    for i in range(pred_seq_len):
+        V_pred = model.decode_step(memory, src_att, v_t)
+        v_t = torch.cat((v_t, V_pred[:, 0:2, -1:, :]), 2)
+    return v_t[:, :, 1:, :].permute(0, 2, 3, 1)
+
+
+def benchmark(fn, runs=20, warmup=3):
+    with torch.no_grad():
+        for _ in range(warmup):
+            fn()
+        time_start = time.time()
+        for _ in range(runs):
+            fn()
+    return (time.time() - time_start) / runs
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--checkpoint', type=str, default='', help='state dict of a trained SGTN')
+    parser.add_argument('--out', type=str, default='sgtn_rollout.pt')
+    parser.add_argument('--n_sstgcn', type=int, default=3)
+    parser.add_argument('--n_txpcnn', type=int, default=5)
+    parser.add_argument('--output_size', type=int, default=5)
+    parser.add_argument('--kernel_size', type=int, default=3)
+    parser.add_argument('--obs_seq_len', type=int, default=8)
+    parser.add_argument('--pred_seq_len', type=int, default=12)
+    parser.add_argument('--emb_size', type=int, default=32)
+    parser.add_argument('--heads', type=int, default=4)
+    parser.add_argument('--layers', type=int, default=6)
+    parser.add_argument('--fw', type=int, default=128)
+    parser.add_argument('--num_person', type=int, default=64)
+    parser.add_argument('--KSTEPS', type=int, default=20)
+    parser.add_argument('--runs', type=int, default=20)
+    parser.add_argument('--compile', action='store_true', default=False,
+                        help='also time torch.compile of the eager rollout')
+    args = parser.parse_args()
+
+    torch.set_grad_enabled(False)
+    model = SGTN(n_sstgcn=args.n_sstgcn, n_txpcnn=args.n_txpcnn, output_feat=args.output_size,
+                 seq_len=args.obs_seq_len, pred_seq_len=args.pred_seq_len, kernel_size=args.kernel_size,
+                 emb_size=args.emb_size, fw=args.fw, heads=args.heads, layers=args.layers)
+    if args.checkpoint:
+        model.load_state_dict(torch.load(args.checkpoint, map_location='cpu'))
+    model.eval()
+
+    v = torch.randn(1, 2, args.obs_seq_len, args.num_person)
+    a = torch.rand(args.obs_seq_len, args.num_person, args.num_person)
+
+    scripted = export_torchscript(model, v, a, args.pred_seq_len)
+    scripted.save(args.out)
+    print('Saved scripted rollout to', args.out)
+    print('Not scriptable in eager SGTN (traced instead):')
+    for feature in UNSUPPORTED:
+        print('  -', feature)
+    print('Use the eager model for:')
+    for feature in EAGER_ONLY:
+        print('  -', feature)
+
+    # parity on a scene size different from the one used for tracing
+    v_check = torch.randn(1, 2, args.obs_seq_len, args.num_person + 3)
+    a_check = torch.rand(args.obs_seq_len, args.num_person + 3, args.num_person + 3)
+    diff = (scripted(v_check, a_check, 1, False) - mean_rollout(model, v_check, a_check, args.pred_seq_len)).abs().max()
+    print('Max abs difference to eager (mean decoding): {:.3e}'.format(diff.item()))
+
+    time_eager = benchmark(lambda: model.rollout(v, a, args.pred_seq_len, args.KSTEPS), args.runs)
+    time_script = benchmark(lambda: scripted(v, a, args.KSTEPS, True), args.runs)
+    print('CPU latency, {:d} agents, {:d} samples'.format(args.num_person, args.KSTEPS))
+    print('  eager   : {:.2f} ms'.format(time_eager * 1000))
+    print('  script  : {:.2f} ms ({:.2f}x)'.format(time_script * 1000, time_eager / time_script))
+    if args.compile:
+        compiled = compile_model(model)
+        time_compiled = benchmark(lambda: compiled(v, a, args.pred_seq_len, args.KSTEPS), args.runs)
+        print('  compile : {:.2f} ms ({:.2f}x)'.format(time_compiled * 1000, time_eager / time_compiled))
@@ -17,39 +17,72 @@ from torch.utils.data import DataLoader
 from numpy import linalg as LA
 import networkx as nx
 
-def final_result(predAll, targetAll): # bs,25,64,2
-    dis1 = np.linalg.norm((predAll[:,4:5,:,:] - targetAll[:,4:5,:,:] ), axis=-1).sum().astype(np.float64)/targetAll.size()[0]/targetAll.size()[2]
-    dis2 = np.linalg.norm((predAll[:,9:10,:,:] - targetAll[:,9:10,:,:] ), axis=-1).sum().astype(np.float64)/targetAll.size()[0]/targetAll.size()[2]
-    dis3 = np.linalg.norm((predAll[:,14:15,:,:] - targetAll[:,14:15,:,:] ), axis=-1).sum().astype(np.float64)/targetAll.size()[0]/targetAll.size()[2]
-    dis4 = np.linalg.norm((predAll[:,19:20,:,:] - targetAll[:,19:20,:,:] ), axis=-1).sum().astype(np.float64)/targetAll.size()[0]/targetAll.size()[2]
-    dis5 = np.linalg.norm((predAll[:,24:25,:,:] - targetAll[:,24:25,:,:] ), axis=-1).sum().astype(np.float64)/targetAll.size()[0]/targetAll.size()[2]
-    return [dis1,dis2,dis3,dis4,dis5]
+CAR_HORIZONS = (4, 9, 14, 19, 24) # 1..5 s at 5 fps on the 25 step car horizon
+
+def horizons_from_seconds(seconds, fps):
+    # step index of every horizon in seconds, e.g. horizons_from_seconds([1, 2, 3, 4, 5], 5) -> [4, 9, 14, 19, 24]
+    return [int(round(sec * fps)) - 1 for sec in seconds]
+
+def _as_numpy(x):
+    return x.detach().cpu().numpy() if torch.is_tensor(x) else np.asarray(x)
+
+def _concat_scenes(scenes, count_):
+    # list of [T, n_s, 2] -> [T, sum(count_), 2], the first count_[s] agents of every scene
+    sizes = np.asarray([scene.shape[1] for scene in scenes])
+    agents = np.concatenate([_as_numpy(scene) for scene in scenes], axis=1)
+    agent = np.arange(sizes.sum()) - np.repeat(np.cumsum(sizes) - sizes, sizes) # index inside its scene
+    return agents[:, agent < np.repeat(count_, sizes)]
+
+def displacement_error(predAll, targetAll, count_=None):
+    """
+    Displacement of every step and agent of a batch of scenes in one pass.
+    predAll, targetAll: [bs, T, num_person, 2] arrays/tensors, or lists of [T, n_s, 2] scenes with different agent counts
+    count_: agents to keep per scene (the first count_[s]), None keeps all
+    Returns error [bs, T, N_max] with the padded agents zeroed and count [bs].
+    """
+    if isinstance(predAll, (list, tuple)):
+        # scenes side by side on the agent axis, one subtraction and norm for all of them
+        if count_ is None:
+            count_ = [pred.shape[1] for pred in predAll]
+        count_ = np.asarray(count_)
+        pred, target = _concat_scenes(predAll, count_), _concat_scenes(targetAll, count_) # [T, sum(count_), 2]
+        error = np.linalg.norm((pred - target).astype(np.float64), axis=-1) # [T, sum(count_)]
+        # scatter the columns back to [bs, T, N_max] by scene offsets
+        scene = np.repeat(np.arange(len(count_)), count_)
+        agent = np.arange(count_.sum()) - np.repeat(np.cumsum(count_) - count_, count_)
+        padded = np.zeros((len(count_), error.shape[0], count_.max()))
+        padded[scene, :, agent] = error.T
+        return padded, count_
+    else:
+        diff = _as_numpy(predAll).astype(np.float64) - _as_numpy(targetAll).astype(np.float64)
+        if count_ is None:
+            count_ = [diff.shape[2]] * diff.shape[0]
+        diff = diff * (np.arange(diff.shape[2])[None, :] < np.asarray(count_)[:, None])[:, None, :, None]
+    return np.linalg.norm(diff, axis=-1), np.asarray(count_)
+
+def horizon_displacement(predAll, targetAll, horizons=None, count_=None):
+    """
+    Mean displacement at each horizon step over all scenes and agents, all horizons in one pass.
+    horizons: step indices, e.g. CAR_HORIZONS or horizons_from_seconds(...); None reports every step.
+    """
+    error, count = displacement_error(predAll, targetAll, count_)
+    if horizons is not None:
+        error = error[:, list(horizons)]
+    return error.sum(axis=(0, 2)) / count.sum()
+
+def final_result(predAll, targetAll, horizons=CAR_HORIZONS): # bs,25,64,2
+    return list(horizon_displacement(predAll, targetAll, horizons))
 
 
 def ade(predAll, targetAll, count_):
-    All = len(predAll)
-    sum_all = 0 
-    for s in range(All):
-        pred = predAll[s][:, :count_[s], :]
-        target = targetAll[s][:, :count_[s], :]
-        N, T = pred.shape[1], pred.shape[0]
-        sum_ = np.linalg.norm((pred - target), axis=-1).sum()
-        sum_all += sum_/(N*T)
-        
-    return sum_all/All
+    # mean over scenes of the per scene average displacement, ragged scenes without a per scene loop
+    error, count = displacement_error(predAll, targetAll, count_) # [bs, T, N_max]
+    return (error.sum(axis=(1, 2)) / (count * error.shape[1])).mean()
 
 
 def fde(predAll, targetAll, count_):
-    All = len(predAll)
-    sum_all = 0.0
-    for s in range(All):
-        pred = predAll[s][-1:, :count_[s], :].astype(np.float64)
-        target = targetAll[s][-1:, :count_[s], :].astype(np.float64)
-        N = pred.shape[1]
-        sum_ = np.linalg.norm((pred - target), axis=-1).sum().astype(np.float64)
-        sum_all += sum_ / N
-
-    return sum_all/All
+    error, count = displacement_error(predAll, targetAll, count_)
+    return (error[:, -1].sum(axis=-1) / count).mean()
 
 def seq_to_nodes(seq_):
     # obs_traj=torch.ones(1, 5, 2, 8)
@@ -78,6 +111,145 @@ def nodes_rel_to_nodes_abs(nodes, init_node):
 
     return torch.tensor(nodes_.squeeze()) #[8, num_person, 2]
 
+def seq_to_nodes_torch(seq_):
+    # seq_to_nodes without leaving the device, [1, num_person, 2, seq_len] -> [seq_len, num_person, 2]
+    return seq_[0].permute(2, 0, 1)
+
+def nodes_rel_to_nodes_abs_torch(nodes, init_node):
+    # [..., 12, num_person, 2] relative steps + [num_person, 2] start -> absolute positions, on device
+    return torch.cumsum(nodes, dim=-3) + init_node
+
+def best_of_k_chain(kstep_V_pred, start, V_y_rel_to_abs):
+    """
+    Greedy best-of-K chaining: at every step each agent continues from its sample closest to the ground truth.
+    kstep_V_pred: [KSTEPS, 12, num_person, 2] relative  start: [num_person, 2]  V_y_rel_to_abs: [12, num_person, 2]
+    Returns the mean distance of the chosen samples per step, [12] on device.
+    """
+    dislist = []
+    for i in range(kstep_V_pred.shape[1]):
+        thispred = kstep_V_pred[:, i] + start # [KSTEPS, num_person, 2]
+        distance = Func.pairwise_distance(thispred, V_y_rel_to_abs[i].expand_as(thispred), p=2) # [KSTEPS, num_person]
+        disres, index = distance.min(dim=0)
+        start = torch.gather(thispred, 0, index.reshape(1, -1, 1).expand(1, -1, 2))[0]
+        dislist.append(disres.mean())
+    return torch.stack(dislist)
+
+class HorizonAccumulator(object):
+    """
+    Running per step displacement, the streaming replacement of stacking every batch for final_result.
+    Sums stay on the device of the first update, result() syncs once.
+    """
+
+    def __init__(self, p=2):
+        self.p = p
+        self.total = None
+        self.count = 0
+
+    def update(self, pred, target=None, num_agents=None):
+        # pred, target: [12, num_person, 2] absolute positions, or pred alone as already reduced distances [12, M]
+        # num_agents: only the first num_agents are real, the rest is padding
+        distance = pred if target is None else Func.pairwise_distance(pred, target, p=self.p) # [12, num_person]
+        if num_agents is not None:
+            distance = distance[..., :num_agents]
+        total = distance.detach().sum(dim=-1)
+        self.total = total if self.total is None else self.total + total
+        self.count += distance.shape[-1]
+
+    def result(self, horizons=None):
+        final = (self.total / self.count).cpu() # [12]
+        return final if horizons is None else final[list(horizons)]
+
+
+class CollisionAccumulator(object):
+    """
+    Running coll_data_post_processing: [X, 56] collision rows in, [11] step and cumulative rates out.
+    num_interp: points compute_col_batch put between two steps, the rows have (T-1)*(num_interp+1)+1 columns.
+    """
+
+    def __init__(self, num_interp=4):
+        self.stride = num_interp + 1
+        self.count = 0
+        self.step_sum = 0.0
+        self.cum_sum = 0.0
+
+    def update(self, coll_raw):
+        if coll_raw is None:
+            return
+        coll_raw = np.asarray(coll_raw, dtype=np.float64) # [X, 56]
+        self.count += coll_raw.shape[0]
+        self.step_sum = self.step_sum + coll_raw.sum(axis=0)
+        # collided up to interpolated step (i+1)*stride, i.e. the max over coll_raw[:, :(i+1)*stride+1]
+        self.cum_sum = self.cum_sum + np.maximum.accumulate(coll_raw, axis=1)[:, self.stride::self.stride].sum(axis=0)
+
+    def result(self):
+        coll_step_ = self.step_sum / self.count # [56]
+        coll_step_ = coll_step_[:-1].reshape(-1, self.stride).mean(axis=1) # [11]
+        return coll_step_, self.cum_sum / self.count
+
+
+class EvalAccumulator(object):
+    """
+    Epoch metrics folded in one evaluate_ksteps result at a time, so nothing per batch is kept around.
+    summary() can be called mid-epoch and returns ade, fde, coll and the joint/cross/truth (step, cumulative) curves.
+    """
+
+    def __init__(self, compute_col_truth=False, truth=None, num_interp=4):
+        # truth: ground-truth collision curves folded once up front (EvalContext), used instead of compute_col_truth
+        self.ade_sum, self.fde_sum, self.coll_sum = 0.0, 0.0, 0.0
+        self.num_ade, self.num_coll = 0, 0
+        self.joint = CollisionAccumulator(num_interp)
+        self.cross = CollisionAccumulator(num_interp)
+        if truth is not None:
+            self.truth = truth
+        else:
+            self.truth = CollisionAccumulator(num_interp) if compute_col_truth else None
+
+    def update(self, result):
+        ade_, fde_, coll_, col_joint, col_cross, col_truth = result
+        self.ade_sum += sum(ade_)
+        self.fde_sum += sum(fde_)
+        self.coll_sum += sum(coll_)
+        self.num_ade += len(ade_)
+        self.num_coll += len(coll_)
+        self.joint.update(col_joint)
+        self.cross.update(col_cross)
+        if self.truth is not None and col_truth is not None:
+            self.truth.update(col_truth)
+
+    def summary(self):
+        coll_joint_step, coll_joint_cum = self.joint.result()
+        coll_cross_step, coll_cross_cum = self.cross.result()
+        if self.truth is not None:
+            coll_truth_step, coll_truth_cum = self.truth.result()
+        else:
+            coll_truth_step, coll_truth_cum = None, None
+        return (self.ade_sum / self.num_ade, self.fde_sum / self.num_ade, self.coll_sum / self.num_coll,
+                coll_joint_step, coll_joint_cum, coll_cross_step, coll_cross_cum, coll_truth_step, coll_truth_cum)
+
+
+class MultiKAccumulator(object):
+    """
+    One EvalAccumulator per K for the {K: result} dicts of evaluate_ksteps(..., ks=ks).
+    summary() is the one of the largest K, summaries() gives {K: summary}.
+    """
+
+    def __init__(self, ks, compute_col_truth=False, truth=None, num_interp=4):
+        self.ks = sorted(ks)
+        # the ground-truth curves do not depend on K, they are only folded once
+        self.accumulators = {K: EvalAccumulator(compute_col_truth and K == self.ks[-1], truth, num_interp) for K in self.ks}
+        for K in self.ks[:-1]:
+            self.accumulators[K].truth = self.accumulators[self.ks[-1]].truth
+
+    def update(self, result):
+        for K in self.ks:
+            self.accumulators[K].update(result[K] if K == self.ks[-1] else result[K][:5] + (None,))
+
+    def summary(self):
+        return self.accumulators[self.ks[-1]].summary()
+
+    def summaries(self):
+        return {K: self.accumulators[K].summary() for K in self.ks}
+
 def closer_to_zero(current,new_v):
     dec =  min([(abs(current),current),(abs(new_v),new_v)])[1]
     if dec != current:
@@ -85,15 +257,18 @@ def closer_to_zero(current,new_v):
     else: 
         return False
         
-def bivariate_loss(V_pred,V_trgt):
+def bivariate_loss(V_pred,V_trgt,mask=None):
     #mux, muy, sx, sy, corr
     #assert V_pred.shape == V_trgt.shape
-    normx = V_trgt[:,:,0]- V_pred[:,:,0]
-    normy = V_trgt[:,:,1]- V_pred[:,:,1]
+    # mask: optional, broadcastable to V_pred[..., 0], False for padded agents
+    # keep the density math in FP32 when V_pred comes out of bf16 autocast
+    V_pred = V_pred.float()
+    normx = V_trgt[...,0]- V_pred[...,0]
+    normy = V_trgt[...,1]- V_pred[...,1]
 
-    sx = torch.exp(V_pred[:,:,2]) #sx
-    sy = torch.exp(V_pred[:,:,3]) #sy
-    corr = torch.tanh(V_pred[:,:,4]) #corr
+    sx = torch.exp(V_pred[...,2]) #sx
+    sy = torch.exp(V_pred[...,3]) #sy
+    corr = torch.tanh(V_pred[...,4]) #corr
     
     sxsy = sx * sy
 
@@ -112,7 +287,24 @@ def bivariate_loss(V_pred,V_trgt):
     epsilon = 1e-20
 
     result = -torch.log(torch.clamp(result, min=epsilon))
+    if mask is not None:
+        result = result[mask.expand_as(result)]
     result = torch.mean(result)
     
     return result
-   
\ No newline at end of file
+
+
+def sample_bivariate(V_pred, ksteps=1, generator=None):
+    """
+    Draw ksteps samples from the bivariate gaussians (mux, muy, sx, sy, corr) with the analytic 2x2 cholesky factor,
+    all at once on V_pred's device. V_pred: [..., 5] -> [ksteps, ..., 2]
+    """
+    V_pred = V_pred.float()
+    sx = torch.exp(V_pred[..., 2]) #sx
+    sy = torch.exp(V_pred[..., 3]) #sy
+    corr = torch.tanh(V_pred[..., 4]) #corr
+
+    noise = torch.randn((ksteps,) + V_pred.shape[:-1] + (2,), device=V_pred.device, generator=generator)
+    dx = sx * noise[..., 0]
+    dy = sy * (corr * noise[..., 0] + torch.sqrt(1 - corr * corr) * noise[..., 1])
+    return V_pred[..., 0:2] + torch.stack((dx, dy), dim=-1)
@@ -16,7 +16,8 @@ from torch.nn.modules.module import Module
 import torch.optim as optim
 import time
 
-from transformer.batch import subsequent_mask
+from transformer.functional import cached_subsequent_mask, cached_src_mask, checkpoint_block
+from transformer.layer_norm import set_fused_norm
 from transformer.noam_opt import NoamOpt
 from transformer.decoder import Decoder
 from transformer.multihead_attention import MultiHeadAttention
@@ -26,7 +27,7 @@ from transformer.encoder_decoder import EncoderDecoder
 from transformer.encoder import Encoder
 from transformer.encoder_layer import EncoderLayer
 from transformer.decoder_layer import DecoderLayer
-from transformer.batch import subsequent_mask
+from metrics import sample_bivariate
 
 import scipy.io
 import copy
@@ -58,40 +59,36 @@ class ConvTemporalGraphical(nn.Module):
             dilation=(t_dilation, 1),
             bias=bias)
 
-        self.emb = nn.Conv1d(
-            64,
-            256,
-            1,
-            bias=True)
-
-        self.demb = nn.Conv1d(
-            256,
-            64,
-            1,
-            bias=True)
-
     def forward(self, x, A):
 
-        assert A.size(0) == self.kernel_size # 8
+        # A is [8, num_person, num_person] for one scene or [bs, 8, num_person, num_person] per sample
+        assert A.size(-3) == self.kernel_size # 8
         x = self.conv(x)
 
         newA = A
         
-        # embA = self.emb(A)
-        # dembA = self.demb(embA)
-        # level_weight = F.softmax(dembA, dim=1)
-        # # newA = level_weight * A
-        
-        # threshold = 0.5  # Adjust this threshold as needed
-        # sparse_level_weight = (level_weight > threshold).float()
-        # newA = sparse_level_weight * A
-        
-        # # Apply graph convolution
-        x = torch.einsum('nctv,tvw->nctw', (x, newA))
+        # Apply graph convolution
+        if newA.dim() == 4:
+            x = torch.einsum('nctv,ntvw->nctw', (x, newA))
+        else:
+            x = torch.einsum('nctv,tvw->nctw', (x, newA))
 
         return x.contiguous(), newA
+
+    def _load_from_state_dict(self, state_dict, prefix, *args, **kwargs):
+        # older checkpoints still carry the unused 64-agent emb/demb Conv1d weights
+        for key in [k for k in state_dict if k.startswith(prefix + 'emb.') or k.startswith(prefix + 'demb.')]:
+            del state_dict[key]
+        super(ConvTemporalGraphical, self)._load_from_state_dict(state_dict, prefix, *args, **kwargs)
     
 
+class ZeroResidual(nn.Module):
+    # stands in for the residual branch when it is disabled, a module instead of a lambda so the block can be traced and pickled
+
+    def forward(self, x):
+        return x.new_zeros(1)
+
+
 class st_gcn(nn.Module):
 
     def __init__(self,
@@ -130,10 +127,10 @@ class st_gcn(nn.Module):
         )
 
         if not residual:
-            self.residual = lambda x: 0
+            self.residual = ZeroResidual()
 
         elif (in_channels == out_channels) and (stride == 1):
-            self.residual = lambda x: x
+            self.residual = nn.Identity()
 
         else:
             self.residual = nn.Sequential(
@@ -163,7 +160,8 @@ class SGTN(nn.Module):
     def __init__(self,n_sstgcn=5,n_txpcnn=1,input_feat=2,output_feat=5,
                  seq_len=8,pred_seq_len=12,kernel_size=3, 
                  emb_size=512, fw=128,heads=8,layers=6,dropout=0.1,
-                 checkpoint_dir='../../../scratch/experiment/'):
+                 checkpoint_dir='../../../scratch/experiment/', attn_backend='reference', fused_norm=False,
+                 checkpoint_layers=0, checkpoint_gcns=0, one_shot=False):
         super(SGTN,self).__init__()
 
         
@@ -186,7 +184,7 @@ class SGTN(nn.Module):
         )
 
         c = copy.deepcopy
-        attn = MultiHeadAttention(heads, emb_size)
+        attn = MultiHeadAttention(heads, emb_size, backend=attn_backend)
         ff = PointerwiseFeedforward(emb_size, fw, dropout)
         position = PositionalEncoding(emb_size, dropout)
 
@@ -202,44 +200,143 @@ class SGTN(nn.Module):
             if p.dim() > 1:
                 nn.init.xavier_uniform_(p)
 
+        # LayerNorm weights are the same for both formulas, the fused one can be toggled on trained models too
+        set_fused_norm(self.model, fused_norm)
+        self.set_checkpointing(checkpoint_layers, checkpoint_gcns)
+
         self.feat = nn.Conv2d(pred_seq_len,pred_seq_len,3,padding=1)
+
+        # non-autoregressive decoding: one learned query per future step, the decoder sees the whole horizon at once
+        # only allocated when enabled so autoregressive checkpoints keep loading
+        self.one_shot = one_shot
+        if one_shot:
+            self.pred_seq_len = pred_seq_len
+            self.query_embed = nn.Parameter(torch.empty(pred_seq_len, emb_size))
+            nn.init.xavier_uniform_(self.query_embed)
+            self.query_position = PositionalEncoding(emb_size, dropout)
         self.prelus = nn.ModuleList()
         for j in range(self.n_txpcnn):
             self.prelus.append(nn.PReLU())
 
 
-    def forward(self,v, a, v_t, return_feat=False):
+    def set_checkpointing(self, layers=0, gcns=0):
+        # activation checkpointing for the first `layers` encoder/decoder layers and the first `gcns` st_gcn blocks
+        self.model.encoder.set_checkpoint_layers(layers)
+        self.model.decoder.set_checkpoint_layers(layers)
+        self.checkpoint_gcns = gcns
+
+    def encode(self, v, a):
         # [1, 2, 8, num_person]  # [8, num_person, num_person] 
 
         for k in range(self.n_sstgcn):
-            v, a = self.st_gcns[k](v, a)
+            if k < self.checkpoint_gcns and self.training and torch.is_grad_enabled():
+                v, a = checkpoint_block(self.st_gcns[k], v, a)
+            else:
+                v, a = self.st_gcns[k](v, a)
+
+        src = v.reshape(-1,v.shape[2],v.shape[1]) # bs*num,8,5
+        src_att = cached_src_mask(src.shape[1], v.device) # [1, 1, 8], broadcast over bs*num
 
+        memory = self.model.encode(src, src_att) # bs*num,8,emb_size
 
+        return memory, src_att, a
+
+    def decode_step(self, memory, src_att, v_t, return_feat=False):
+        # memory and src_att come from encode() and can be reused for every autoregressive step
         device = v_t.device
-        # [1, 2, 7, num_person]  # [2, num_person, num_person]  # [1, 3, 12, num_person] #[num_person]
- 
-        # if (v_t.size()[1]==2):
+        # [1, 2, 12, num_person]
+
         v_t = self.target_embedding(v_t) # [1, 5, 12, num_person]
 
-        src = v.reshape(-1,v.shape[2],v.shape[1]) # bs*num,8,5
         trg = v_t.reshape(-1,v_t.shape[2],v_t.shape[1]) # bs*num,12,5
+        trg_att=cached_subsequent_mask(trg.shape[1], device) # [1, 12, 12], broadcast over bs*num
+
+        pred=self.model.generator(self.model.decode(memory, src_att, trg, trg_att)) # bs*num,12,5
+
+        return self._output(pred, v_t.shape[3], return_feat)
 
-        src_att = torch.ones((src.shape[0], 1,src.shape[1])).to(device) # [bs*num, 1, 8]
-        trg_att=subsequent_mask(trg.shape[1]).repeat(trg.shape[0],1,1).to(device) # [bs*num, 12, 12]
+    def decode_one_shot(self, memory, src_att, num_person, return_feat=False):
+        # whole horizon in one decoder pass from the learned queries, no causal mask
+        assert self.one_shot, 'SGTN was built without one_shot=True'
+        query = self.query_embed.unsqueeze(0).expand(memory.size(0), -1, -1) # bs*num,12,emb_size
 
-        pred=self.model.generator(self.model(src, trg, src_att, trg_att)) # bs*num,12,5
+        pred = self.model.generator(self.model.decoder(self.query_position(query), memory, src_att, None)) # bs*num,12,5
 
+        return self._output(pred, num_person, return_feat)
+
+    def _output(self, pred, num_person, return_feat):
+        # bs*num,12,5 -> [1, 5, 12, num_person] (+ contrastive features)
         if return_feat:
-            feat = self.feat(pred.reshape(-1,pred.shape[1],pred.shape[2],v_t.shape[3]))  # [1, 12, 5, num_person]
+            feat = self.feat(pred.reshape(-1,pred.shape[1],pred.shape[2],num_person))  # [1, 12, 5, num_person]
             feat = feat.reshape(feat.size()[3],-1)
 
-        pred = pred.reshape(-1, pred.shape[2], pred.shape[1], v_t.shape[3]) # [1, 5, 12, num_person]
+        pred = pred.reshape(-1, pred.shape[2], pred.shape[1], num_person) # [1, 5, 12, num_person]
 
         if return_feat:
+            return pred, feat
+        else:
+            return pred
+
+    def rollout(self, v, a, pred_seq_len, ksteps=20):
+        # [1, 2, 8, num_person]  # [8, num_person, num_person] 
+        # decode ksteps sampled hypotheses side by side, returns [ksteps, pred_seq_len, num_person, 2]
+        memory, src_att, _ = self.encode(v, a)
+
+        if self.one_shot:
+            if pred_seq_len > self.query_embed.shape[0]:
+                raise ValueError('pred_seq_len {:d} is longer than the one-shot horizon {:d}'.format(
+                    pred_seq_len, self.query_embed.shape[0]))
+            # the horizon does not depend on earlier draws, sample every step of every hypothesis at once
+            V_pred = self.decode_one_shot(memory, src_att, v.shape[3]) # [1, 5, pred_seq_len, num_person]
+            V_pred = V_pred[:, :, :pred_seq_len].float()
+            traj = sample_bivariate(V_pred[0].permute(1, 2, 0), ksteps) # [ksteps, pred_seq_len, num_person, 2]
+            return traj, V_pred.repeat(ksteps, 1, 1, 1) # [ksteps, pred_seq_len, num_person, 2], [ksteps, 5, pred_seq_len, num_person]
+
+        # every hypothesis attends to the same memory, tile it once along the decoder batch
+        memory = memory.repeat(ksteps, 1, 1) # ksteps*num,8,emb_size
+
+        v_t = v[:, :, -1:, :].repeat(ksteps, 1, 1, 1) # [ksteps, 2, 1, num_person]
+
+        for i in range(pred_seq_len):
+            V_pred = self.decode_step(memory, src_att, v_t) # [ksteps, 5, i+1, num_person]
+            V_step = V_pred[:, :, -1, :].permute(0, 2, 1) # [ksteps, num_person, 5]
+
+            output = sample_bivariate(V_step)[0] # one draw per hypothesis [ksteps, num_person, 2]
+            v_t = torch.cat((v_t, output.permute(0, 2, 1).unsqueeze(2)), 2) # [ksteps, 2, i+2, num_person]
+
+        traj = v_t[:, :, 1:, :].permute(0, 2, 3, 1)
+        return traj, V_pred # [ksteps, pred_seq_len, num_person, 2], [ksteps, 5, pred_seq_len, num_person]
+
+    def forward(self,v, a, v_t, return_feat=False):
+        # [1, 2, 8, num_person]  # [8, num_person, num_person] 
+        # with one_shot the decoder input v_t is ignored, the queries stand in for it
+
+        memory, src_att, a = self.encode(v, a)
+
+        if self.one_shot:
+            out = self.decode_one_shot(memory, src_att, v.shape[3], return_feat)
+            return (out[0], a, out[1]) if return_feat else (out, a)
+
+        if return_feat:
+            pred, feat = self.decode_step(memory, src_att, v_t, return_feat=True)
             return pred,a, feat
         else:
+            pred = self.decode_step(memory, src_att, v_t)
             return pred,a
 
+    def train_step(self, v, a, v_t, return_feat=True):
+        # one teacher forced pass for training, returns pred [1, 5, 12, num_person], feat [num_person, 60] or None
+        # and the encoder memory bs*num,8,emb_size; the contrastive head is skipped when return_feat is False
+        memory, src_att, _ = self.encode(v, a)
+
+        if self.one_shot:
+            out = self.decode_one_shot(memory, src_att, v.shape[3], return_feat)
+        else:
+            out = self.decode_step(memory, src_att, v_t, return_feat)
+
+        pred, feat = out if return_feat else (out, None)
+        return pred, feat, memory
+
 
 
         
@@ -15,7 +15,8 @@ from torch.nn.modules.module import Module
 import torch.optim as optim
 import time
 
-from transformer.batch import subsequent_mask
+from transformer.functional import cached_subsequent_mask, cached_src_mask, checkpoint_block
+from transformer.layer_norm import set_fused_norm
 from transformer.noam_opt import NoamOpt
 from transformer.decoder import Decoder
 from transformer.multihead_attention import MultiHeadAttention
@@ -25,7 +26,7 @@ from transformer.encoder_decoder import EncoderDecoder
 from transformer.encoder import Encoder
 from transformer.encoder_layer import EncoderLayer
 from transformer.decoder_layer import DecoderLayer
-from transformer.batch import subsequent_mask
+from metrics import sample_bivariate
 
 import scipy.io
 import copy
@@ -34,6 +35,41 @@ import math
 from torch.utils.tensorboard import SummaryWriter
 
 
+class AdaptiveAdjacency(nn.Module):
+    """
+    Re-weights the edges of A with a pairwise MLP on (x_v, x_w, A_vw), computed on the non-zero edges only.
+    Weights are normalized over the source agents v of every target w, like the softmax of the old 64-agent
+    emb/demb branch, but nothing depends on num_person.
+    """
+
+    def __init__(self, channels, hidden=16):
+        super(AdaptiveAdjacency, self).__init__()
+        self.edge_mlp = nn.Sequential(
+            nn.Linear(2 * channels + 1, hidden),
+            nn.PReLU(),
+            nn.Linear(hidden, 1))
+
+    def forward(self, x, A):
+        # x: [n, c, 8, num_person]  # A: [8, num_person, num_person] or [n, 8, num_person, num_person]
+        if A.dim() == 3:
+            A = A.unsqueeze(0).expand(x.shape[0], -1, -1, -1)
+        b, t, v, w = A.nonzero(as_tuple=True) # E edges
+        node = x.permute(0, 2, 3, 1) # [n, 8, num_person, c]
+        edge = torch.cat((node[b, t, v], node[b, t, w], A[b, t, v, w].unsqueeze(1).type_as(node)), 1) # E, 2c+1
+        logit = self.edge_mlp(edge).squeeze(1) # E
+
+        # softmax over the sources v of every (b, t, w) group
+        group = (b * A.shape[1] + t) * A.shape[3] + w
+        num_groups = A.shape[0] * A.shape[1] * A.shape[3]
+        logit_max = logit.new_full((num_groups,), -float('inf')).scatter_reduce(0, group, logit, 'amax')
+        score = torch.exp(logit - logit_max[group])
+        level_weight = score / score.new_zeros(num_groups).index_add(0, group, score)[group]
+
+        newA = torch.zeros(A.shape, dtype=level_weight.dtype, device=A.device)
+        newA[b, t, v, w] = level_weight * A[b, t, v, w].type_as(level_weight)
+        return newA
+
+
 class ConvTemporalGraphical(nn.Module):
     #Source : https://github.com/yysijie/st-gcn/blob/master/net/st_gcn.py
 
@@ -59,38 +95,94 @@ class ConvTemporalGraphical(nn.Module):
             dilation=(t_dilation, 1),
             bias=bias)
 
-        self.emb = nn.Conv1d(
-            64,
-            256,
-            1,
-            bias=True)
-
-        self.demb = nn.Conv1d(
-            256,
-            64,
-            1,
-            bias=True)
+        # attnaj == 1: legacy adjacency re-weighting, Conv1d over the rows of A, only valid for 64 agents
+        # attnaj == 2: AdaptiveAdjacency, works for any number of agents
+        if attnaj == 1:
+            self.emb = nn.Conv1d(
+                64,
+                256,
+                1,
+                bias=True)
+
+            self.demb = nn.Conv1d(
+                256,
+                64,
+                1,
+                bias=True)
+        elif attnaj == 2:
+            self.adaptive = AdaptiveAdjacency(out_channels)
 
     def forward(self, x, A):
-        assert A.size(0) == self.kernel_size # 8
+        # A is [8, num_person, num_person] for one scene or [bs, 8, num_person, num_person] per sample
+        assert A.size(-3) == self.kernel_size # 8
         x = self.conv(x)
 
         if (self.attnaj == 1):
-            embA = self.emb(A)
+            flatA = A.reshape(-1, A.size(-2), A.size(-1)) # [bs*8, num_person, num_person]
+            embA = self.emb(flatA)
             dembA = self.demb(embA)
             level_weight = F.softmax(dembA, dim=1)
-            newA = level_weight * A
+            newA = level_weight.reshape(A.shape) * A
             # threshold = 0.5  # Adjust this threshold as needed
             # sparse_level_weight = (level_weight > threshold).float()
             # newA = sparse_level_weight * A
+        elif (self.attnaj == 2):
+            newA = self.adaptive(x, A)
         else:
             newA = A
 
 
-        x = torch.einsum('nctv,tvw->nctw', (x, newA))
+        if newA.dim() == 4:
+            x = torch.einsum('nctv,ntvw->nctw', (x, newA))
+        else:
+            x = torch.einsum('nctv,tvw->nctw', (x, newA))
         return x.contiguous(), A
+
+    def _load_from_state_dict(self, state_dict, prefix, *args, **kwargs):
+        # checkpoints from before the layers were made optional carry emb/demb whatever attnaj was
+        if self.attnaj != 1:
+            for key in [k for k in state_dict if k.startswith(prefix + 'emb.') or k.startswith(prefix + 'demb.')]:
+                del state_dict[key]
+        super(ConvTemporalGraphical, self)._load_from_state_dict(state_dict, prefix, *args, **kwargs)
     
 
+class MaskedBatchNorm2d(nn.BatchNorm2d):
+    """
+    BatchNorm2d over [bs, c, t, num_person] whose batch statistics only count the real agents of
+    agent_mask [bs, num_person], zero padded agents then do not shift the outputs of the real ones.
+    Without a mask it is the plain BatchNorm2d, the parameters and buffers are the same.
+    """
+
+    def forward(self, x, agent_mask=None):
+        use_batch_stats = self.training or not self.track_running_stats
+        if agent_mask is None or not use_batch_stats:
+            return super(MaskedBatchNorm2d, self).forward(x)
+
+        mask = agent_mask[:, None, None, :].type_as(x) # [bs, 1, 1, num_person]
+        count = mask.sum() * x.shape[2]
+        mean = (x * mask).sum(dim=(0, 2, 3)) / count # [c]
+        var = ((x - mean[None, :, None, None]) ** 2 * mask).sum(dim=(0, 2, 3)) / count
+
+        if self.training and self.track_running_stats:
+            self.num_batches_tracked.add_(1)
+            factor = 1.0 / float(self.num_batches_tracked) if self.momentum is None else self.momentum
+            with torch.no_grad():
+                self.running_mean.mul_(1 - factor).add_(mean * factor)
+                self.running_var.mul_(1 - factor).add_(var * count / (count - 1).clamp(min=1) * factor)
+
+        x = (x - mean[None, :, None, None]) / torch.sqrt(var[None, :, None, None] + self.eps)
+        if self.affine:
+            x = x * self.weight[None, :, None, None] + self.bias[None, :, None, None]
+        return x
+
+
+class ZeroResidual(nn.Module):
+    # stands in for the residual branch when it is disabled, a module instead of a lambda so the block can be traced and pickled
+
+    def forward(self, x):
+        return x.new_zeros(1)
+
+
 class st_gcn(nn.Module):
 
     def __init__(self,
@@ -130,10 +222,10 @@ class st_gcn(nn.Module):
         )
 
         if not residual:
-            self.residual = lambda x: 0
+            self.residual = ZeroResidual()
 
         elif (in_channels == out_channels) and (stride == 1):
-            self.residual = lambda x: x
+            self.residual = nn.Identity()
 
         else:
             self.residual = nn.Sequential(
@@ -142,14 +234,17 @@ class st_gcn(nn.Module):
                     out_channels,
                     kernel_size=1,
                     stride=(stride, 1)),
-                nn.BatchNorm2d(out_channels),
+                MaskedBatchNorm2d(out_channels),
             )
 
         self.prelu = nn.PReLU()
 
-    def forward(self, x, A):
-
-        res = self.residual(x)
+    def forward(self, x, A, agent_mask=None):
+        # agent_mask: [bs, num_person], False for padded agents, kept out of the BatchNorm statistics
+        if isinstance(self.residual, nn.Sequential):
+            res = self.residual[1](self.residual[0](x), agent_mask)
+        else:
+            res = self.residual(x)
         x, A = self.gcn(x, A)
 
         # x = self.tcn(x) + res.contiguous()
@@ -164,7 +259,8 @@ class SGTN(nn.Module):
     def __init__(self,n_sstgcn=1,n_txpcnn=5,input_feat=2,output_feat=5,
                  seq_len=15,pred_seq_len=25,kernel_size=3, 
                  emb_size=8, fw=32,heads=6,layers=4,dropout=0.1,
-                 checkpoint_dir='../../../scratch/experiment/', modelnum=1, attnaj=0):
+                 checkpoint_dir='../../../scratch/experiment/', modelnum=1, attnaj=0, attn_backend='reference', fused_norm=False,
+                 checkpoint_layers=0, checkpoint_gcns=0):
         super(SGTN,self).__init__()
 
         self.modelnum=modelnum
@@ -196,7 +292,7 @@ class SGTN(nn.Module):
 
         c = copy.deepcopy
 
-        attn = MultiHeadAttention(heads, emb_size)
+        attn = MultiHeadAttention(heads, emb_size, backend=attn_backend)
         ff = PointerwiseFeedforward(emb_size, fw, dropout)
         position = PositionalEncoding(emb_size, dropout)
         self.model = EncoderDecoder(
@@ -212,40 +308,108 @@ class SGTN(nn.Module):
             if p.dim() > 1:
                 nn.init.xavier_uniform_(p)
 
+        # LayerNorm weights are the same for both formulas, the fused one can be toggled on trained models too
+        set_fused_norm(self.model, fused_norm)
+        self.set_checkpointing(checkpoint_layers, checkpoint_gcns)
+
     
         self.feat = nn.Conv2d(pred_seq_len,pred_seq_len,3,padding=1)
 
 
 
-    def forward(self,v, a, v_t,flag,newtrans,v_pred):
-        # [1, 2, 8, num_person]  # [8, num_person, num_person] 
+    def set_checkpointing(self, layers=0, gcns=0):
+        # activation checkpointing for the first `layers` encoder/decoder layers and the first `gcns` st_gcn blocks
+        self.model.encoder.set_checkpoint_layers(layers)
+        self.model.decoder.set_checkpoint_layers(layers)
+        self.checkpoint_gcns = gcns
+
+    def encode(self, v, a, agent_mask=None):
+        # [bs, 2, 8, num_person]  # [8, num_person, num_person] or [bs, 8, num_person, num_person]
+        # agent_mask: [bs, num_person] of padded scenes, see utils.collate_scenes
         if (self.modelnum == 1):
             for k in range(self.n_sstgcn):
-                v, a = self.st_gcns[k](v, a)
+                if k < self.checkpoint_gcns and self.training and torch.is_grad_enabled():
+                    v, a = checkpoint_block(self.st_gcns[k], v, a, agent_mask)
+                else:
+                    v, a = self.st_gcns[k](v, a, agent_mask)
         elif (self.modelnum == 2):
             v = self.src_embedding(v)
 
+        src = v.permute(0,3,2,1).reshape(-1,v.shape[2],v.shape[1]) # bs*num,8,5
+        src_att = cached_src_mask(src.shape[1], v.device) # [1, 1, 8], broadcast over bs*num
+
+        memory = self.model.encode(src, src_att) # bs*num,8,emb_size
+
+        return memory, src_att, a
 
+    def select_agents(self, memory, agent_idx, bs=1):
+        # keep the encoder rows of the focal agents, bs*num,8,emb_size -> bs*len(agent_idx),8,emb_size
+        memory = memory.reshape(bs, -1, memory.shape[1], memory.shape[2])
+        return memory[:, agent_idx].reshape(-1, memory.shape[2], memory.shape[3])
+
+    def decode_step(self, memory, src_att, v_t, flag=-1, newtrans=0, v_pred=None, agent_mask=None, agent_idx=None):
+        # memory and src_att come from encode() and can be reused for every autoregressive step
         device = v_t.device
-        # [1, 2, 7, num_person]  # [2, num_person, num_person]  # [1, 3, 12, num_person] #[num_person]
- 
+        # [bs, 2, 12, num_person]  # agent_mask: [bs, num_person], False for padded agents
+        # agent_idx: optional focal agents, the scene was encoded in full but only these rows are decoded.
+        # v_t and v_pred then hold the focal agents only, [bs, 2, 12, len(agent_idx)]
+        if agent_idx is not None:
+            memory = self.select_agents(memory, agent_idx, v_t.shape[0])
+            if agent_mask is not None:
+                agent_mask = agent_mask[:, agent_idx]
 
         v_t = self.target_embedding(v_t) # [1, 5, 12, num_person]
         if( flag>0 and newtrans==1):
             v_t= torch.cat((v_t, v_pred), 2)
 
-        src = v.squeeze(0).permute(2,1,0) # bs*num,8,5
-        trg = v_t.squeeze(0).permute(2,1,0) # bs*num,12,5
+        trg = v_t.permute(0,3,2,1).reshape(-1,v_t.shape[2],v_t.shape[1]) # bs*num,12,5
+        trg_att=cached_subsequent_mask(trg.shape[1], device) # [1, 12, 12], broadcast over bs*num
 
-        src_att = torch.ones((src.shape[0], 1,src.shape[1])).to(device) # [bs*num, 1, 8]
-        trg_att=subsequent_mask(trg.shape[1]).repeat(trg.shape[0],1,1).to(device) # [bs*num, 12, 12]
+        pred=self.model.generator(self.model.decode(memory, src_att, trg, trg_att)) # bs*num,12,5
 
-        pred=self.model.generator(self.model(src, trg, src_att, trg_att)) # bs*num,12,5
+        pred = pred.reshape(v_t.shape[0],v_t.shape[3],pred.shape[1],pred.shape[2]).permute(0,3,2,1) # [bs, 5, 12, num_person]
 
-        pred = pred.permute(2,1,0).unsqueeze(0) # [1, 5, 12, num_person]
+        if agent_mask is not None:
+            # the transformer rows are agents, padded agents never mix with real ones there, only blank their outputs
+            pred = pred * agent_mask[:, None, None, :].type_as(pred)
 
         return pred
 
+    def rollout(self, v, a, pred_seq_len, ksteps=20, agent_idx=None):
+        # [1, 2, 8, num_person]  # [8, num_person, num_person] 
+        # decode ksteps sampled hypotheses side by side, returns [ksteps, pred_seq_len, num_person, 2]
+        # with agent_idx only the focal agents are decoded, num_person becomes len(agent_idx)
+        assert v.shape[0] == 1
+        memory, src_att, _ = self.encode(v, a)
+        if agent_idx is not None:
+            memory = self.select_agents(memory, agent_idx)
+            v = v[:, :, :, agent_idx]
+        num_person = v.shape[3]
+
+        # rows of the decoder batch are agents, stack the hypotheses as extra agents sharing the memory
+        memory = memory.repeat(ksteps, 1, 1) # ksteps*num,8,emb_size
+
+        v_t = v[:, :, -1:, :].repeat(1, 1, 1, ksteps) # [1, 2, 1, ksteps*num_person]
+
+        for i in range(pred_seq_len):
+            V_pred = self.decode_step(memory, src_att, v_t) # [1, 5, i+1, ksteps*num_person]
+            V_step = V_pred[0, :, -1, :].reshape(-1, ksteps, num_person).permute(1, 2, 0) # [ksteps, num_person, 5]
+
+            output = sample_bivariate(V_step)[0] # one draw per hypothesis [ksteps, num_person, 2]
+            output = output.permute(2, 0, 1).reshape(1, 2, 1, -1) # [1, 2, 1, ksteps*num_person]
+            v_t = torch.cat((v_t, output), 2)
+
+        traj = v_t[0, :, 1:, :].reshape(2, pred_seq_len, ksteps, num_person).permute(2, 1, 3, 0)
+        V_pred = V_pred[0].reshape(V_pred.shape[1], pred_seq_len, ksteps, num_person).permute(2, 0, 1, 3)
+        return traj, V_pred # [ksteps, pred_seq_len, num_person, 2], [ksteps, 5, pred_seq_len, num_person]
+
+    def forward(self,v, a, v_t,flag,newtrans,v_pred, agent_mask=None, agent_idx=None):
+        # [bs, 2, 8, num_person]  # [bs, 8, num_person, num_person], scenes padded to the same num_person
+        # agent_idx: decode only these agents, v_t / v_pred / output cover len(agent_idx) agents
+        memory, src_att, _ = self.encode(v, a, agent_mask)
+
+        return self.decode_step(memory, src_att, v_t, flag, newtrans, v_pred, agent_mask, agent_idx)
+
         
 
 
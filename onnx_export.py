@@ -0,0 +1,178 @@
+import argparse
+import inspect
+
+import numpy as np
+import torch
+import torch.nn as nn
+
+from model import SGTN
+from transformer.functional import cached_src_mask
+
+
+class OnnxEncoder(nn.Module):
+    """
+    st_gcn stack + transformer encoder, [1, 2, 8, num_person] x [8, num_person, num_person] -> memory.
+    """
+
+    def __init__(self, model):
+        super(OnnxEncoder, self).__init__()
+        self.model = model
+
+    def forward(self, v, a):
+        memory, _, _ = self.model.encode(v, a)
+        return memory # num,8,emb_size
+
+
+class OnnxDecoderStep(nn.Module):
+    """
+    One decoder pass of SGTN.decode_step. The causal mask is built from the prefix length inside the
+    graph instead of the Python mask cache, so one graph serves every autoregressive step.
+    """
+
+    def __init__(self, model):
+        super(OnnxDecoderStep, self).__init__()
+        self.model = model
+
+    def forward(self, memory, v_t):
+        # memory: ksteps*num,8,emb_size  # v_t: [ksteps, 2, T, num_person]
+        v_t = self.model.target_embedding(v_t) # [ksteps, 5, T, num_person]
+        trg = v_t.reshape(-1, v_t.shape[2], v_t.shape[1]) # ksteps*num,T,5
+        ones = torch.ones_like(trg[0, :, 0]) # [T]
+        trg_att = torch.tril(ones[:, None] * ones[None, :]).unsqueeze(0) # [1, T, T]
+        src_att = cached_src_mask(memory.size(1), memory.device)
+        pred = self.model.model.generator(self.model.model.decode(memory, src_att, trg, trg_att)) # ksteps*num,T,5
+        return pred.reshape(-1, pred.shape[2], pred.shape[1], v_t.shape[3]) # [ksteps, 5, T, num_person]
+
+
+def _export(module, args, path, input_names, output_names, dynamic_axes, opset):
+    kwargs = {}
+    if 'dynamo' in inspect.signature(torch.onnx.export).parameters:
+        # the TorchScript based exporter understands dynamic_axes
+        kwargs['dynamo'] = False
+    torch.onnx.export(module, args, path, input_names=input_names, output_names=output_names,
+                      dynamic_axes=dynamic_axes, opset_version=opset, **kwargs)
+
+
+def export_onnx(model, encoder_path, decoder_path, obs_seq_len=8, num_person=64, opset=14):
+    """
+    Write the encoder and one decoder step of model as ONNX graphs with dynamic agent (and sample/prefix) axes.
+    """
+    # the exporter restores the wrapper's train/eval mode afterwards, which propagates to model
+    encoder = OnnxEncoder(model).eval()
+    decoder = OnnxDecoderStep(model).eval()
+    v = torch.randn(1, 2, obs_seq_len, num_person)
+    a = torch.rand(obs_seq_len, num_person, num_person)
+    with torch.no_grad():
+        _export(encoder, (v, a), encoder_path, ['v', 'a'], ['memory'],
+                {'v': {3: 'num_person'}, 'a': {1: 'num_person', 2: 'num_person'}, 'memory': {0: 'num_person'}}, opset)
+        memory = encoder(v, a).repeat(2, 1, 1)
+        v_t = torch.randn(2, 2, 3, num_person)
+        _export(decoder, (memory, v_t), decoder_path, ['memory', 'v_t'], ['V_pred'],
+                {'memory': {0: 'rows'}, 'v_t': {0: 'ksteps', 2: 'prefix', 3: 'num_person'},
+                 'V_pred': {0: 'ksteps', 2: 'prefix', 3: 'num_person'}}, opset)
+
+
+def sample_bivariate_np(V_step, rng):
+    """
+    Draw one sample per row from (mux, muy, sx, sy, corr) with the analytic 2x2 cholesky factor.
+    V_step: [..., 5] -> [..., 2]
+    """
+    sx = np.exp(V_step[..., 2])
+    sy = np.exp(V_step[..., 3])
+    corr = np.tanh(V_step[..., 4])
+    noise = rng.standard_normal(V_step[..., :2].shape).astype(V_step.dtype)
+    dx = sx * noise[..., 0]
+    dy = sy * (corr * noise[..., 0] + np.sqrt(1 - corr * corr) * noise[..., 1])
+    return V_step[..., :2] + np.stack((dx, dy), axis=-1)
+
+
+class OnnxSGTN(object):
+    """
+    CPU inference of SGTN on onnxruntime, no torch needed at run time.
+    """
+
+    def __init__(self, encoder_path, decoder_path, providers=('CPUExecutionProvider',)):
+        import onnxruntime
+        self.encoder = onnxruntime.InferenceSession(encoder_path, providers=list(providers))
+        self.decoder = onnxruntime.InferenceSession(decoder_path, providers=list(providers))
+
+    def encode(self, v, a):
+        return self.encoder.run(None, {'v': v.astype(np.float32), 'a': a.astype(np.float32)})[0]
+
+    def decode_step(self, memory, v_t):
+        return self.decoder.run(None, {'memory': memory, 'v_t': v_t.astype(np.float32)})[0]
+
+    def rollout(self, v, a, pred_seq_len, ksteps=20, sample=True, seed=None):
+        # [1, 2, 8, num_person]  # [8, num_person, num_person] -> [ksteps, pred_seq_len, num_person, 2]
+        rng = np.random.default_rng(seed)
+        memory = np.tile(self.encode(v, a), (ksteps, 1, 1))
+        v_t = np.tile(v[:, :, -1:, :].astype(np.float32), (ksteps, 1, 1, 1))
+        for i in range(pred_seq_len):
+            V_step = self.decode_step(memory, v_t)[:, :, -1, :].transpose(0, 2, 1) # [ksteps, num_person, 5]
+            output = sample_bivariate_np(V_step, rng) if sample else V_step[..., :2]
+            v_t = np.concatenate((v_t, output.transpose(0, 2, 1)[:, :, None, :]), axis=2)
+        return v_t[:, :, 1:, :].transpose(0, 2, 3, 1)
+
+
+def check_parity(model, runtime, obs_seq_len=8, pred_seq_len=12, num_person=64, ksteps=3):
+    """
+    Compare the onnxruntime encoder, decoder step and mean rollout against model.SGTN.
+    Returns the max abs differences.
+    """
+    model.eval()
+    v = torch.randn(1, 2, obs_seq_len, num_person)
+    a = torch.rand(obs_seq_len, num_person, num_person)
+    with torch.no_grad():
+        memory, src_att, _ = model.encode(v, a)
+        memory = memory.repeat(ksteps, 1, 1)
+        v_t = torch.randn(ksteps, 2, 5, num_person)
+        V_pred = model.decode_step(memory, src_att, v_t)
+
+        v_roll = v[:, :, -1:, :]
+        for i in range(pred_seq_len):
+            V_roll = model.decode_step(memory[:num_person], src_att, v_roll)
+            v_roll = torch.cat((v_roll, V_roll[:, 0:2, -1:, :]), 2)
+        traj = v_roll[:, :, 1:, :].permute(0, 2, 3, 1)
+
+    memory_ort = runtime.encode(v.numpy(), a.numpy())
+    V_pred_ort = runtime.decode_step(np.tile(memory_ort, (ksteps, 1, 1)), v_t.numpy())
+    traj_ort = runtime.rollout(v.numpy(), a.numpy(), pred_seq_len, ksteps=1, sample=False)
+    return {
+        'encoder': np.abs(memory_ort - memory[:num_person].numpy()).max(),
+        'decoder_step': np.abs(V_pred_ort - V_pred.numpy()).max(),
+        'rollout': np.abs(traj_ort - traj.numpy()).max(),
+    }
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--checkpoint', type=str, default='', help='state dict of a trained SGTN')
+    parser.add_argument('--encoder', type=str, default='sgtn_encoder.onnx')
+    parser.add_argument('--decoder', type=str, default='sgtn_decoder_step.onnx')
+    parser.add_argument('--n_sstgcn', type=int, default=3)
+    parser.add_argument('--n_txpcnn', type=int, default=5)
+    parser.add_argument('--output_size', type=int, default=5)
+    parser.add_argument('--kernel_size', type=int, default=3)
+    parser.add_argument('--obs_seq_len', type=int, default=8)
+    parser.add_argument('--pred_seq_len', type=int, default=12)
+    parser.add_argument('--emb_size', type=int, default=32)
+    parser.add_argument('--heads', type=int, default=4)
+    parser.add_argument('--layers', type=int, default=6)
+    parser.add_argument('--fw', type=int, default=128)
+    parser.add_argument('--opset', type=int, default=14)
+    args = parser.parse_args()
+
+    model = SGTN(n_sstgcn=args.n_sstgcn, n_txpcnn=args.n_txpcnn, output_feat=args.output_size,
+                 seq_len=args.obs_seq_len, pred_seq_len=args.pred_seq_len, kernel_size=args.kernel_size,
+                 emb_size=args.emb_size, fw=args.fw, heads=args.heads, layers=args.layers)
+    if args.checkpoint:
+        model.load_state_dict(torch.load(args.checkpoint, map_location='cpu'))
+    model.eval()
+
+    export_onnx(model, args.encoder, args.decoder, args.obs_seq_len, opset=args.opset)
+    print('Saved', args.encoder, 'and', args.decoder)
+
+    runtime = OnnxSGTN(args.encoder, args.decoder)
+    for num_person in [16, 64, 100]:
+        diffs = check_parity(model, runtime, args.obs_seq_len, args.pred_seq_len, num_person)
+        print('num_person {:d}: '.format(num_person) + ', '.join('{:s} {:.3e}'.format(k, v) for k, v in diffs.items()))
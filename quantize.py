@@ -0,0 +1,38 @@
+import copy
+import time
+
+import torch
+import torch.nn as nn
+
+
+def quantize_for_cpu(model):
+    """
+    Dynamic INT8 copy of model for CPU inference. Only the nn.Linear layers are quantized
+    (MultiHeadAttention.linears, PointerwiseFeedforward, LinearEmbedding and Generator),
+    the st_gcn convolutions stay in FP32. The original model is left untouched.
+    """
+    model = copy.deepcopy(model).to(torch.device('cpu')).eval()
+    return torch.quantization.quantize_dynamic(model, {nn.Linear}, dtype=torch.qint8)
+
+
+def compare_quantized(evaluate, model, seed=0):
+    """
+    Run evaluate(model) for the FP32 model and its INT8 copy on CPU with the same random draws.
+    evaluate returns (ade, fde, col), the result maps 'FP32'/'INT8' to (ade, fde, col, seconds).
+    """
+    model_fp32 = copy.deepcopy(model).to(torch.device('cpu')).eval()
+    results = {}
+    for name, cur_model in [('FP32', model_fp32), ('INT8', quantize_for_cpu(model_fp32))]:
+        torch.manual_seed(seed)
+        time_start = time.time()
+        ade_, fde_, col_ = evaluate(cur_model)
+        results[name] = (ade_, fde_, col_, time.time() - time_start)
+    return results
+
+
+def format_comparison(results):
+    ade_32, fde_32, col_32, time_32 = results['FP32']
+    ade_8, fde_8, col_8, time_8 = results['INT8']
+    return ('INT8 vs FP32: speedup {:.2f}x ({:.2f}s vs {:.2f}s), ADE {:.4f} ({:+.4f}), FDE {:.4f} ({:+.4f}), '
+            'COL {:.4f} ({:+.4f})').format(time_32 / time_8, time_8, time_32, ade_8, ade_8 - ade_32,
+                                          fde_8, fde_8 - fde_32, col_8, col_8 - col_32)
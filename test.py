@@ -2,10 +2,10 @@ import pandas as pd
 import pickle
 import argparse
 import glob
-import torch.distributions.multivariate_normal as torchdist
 from utils import *
 from metrics import *
 from model import SGTN
+from quantize import compare_quantized, format_comparison
 import copy
 import random
 import time
@@ -19,40 +19,7 @@ np.random.seed(random_seed)
 torch.manual_seed(random_seed)
 
 
-def interpolate_traj(traj, num_interp=4):
-    '''
-    Add linearly interpolated points of a trajectory
-    '''
-    sz = traj.shape
-    dense = np.zeros((sz[0], (sz[1] - 1) * (num_interp + 1) + 1, 2))
-    dense[:, :1, :] = traj[:, :1]
-
-    for i in range(num_interp+1):
-        ratio = (i + 1) / (num_interp + 1)
-        dense[:, i+1::num_interp+1, :] = traj[:, 0:-1] * (1 - ratio) + traj[:, 1:] * ratio
-
-    return dense
-
-
-def compute_col(predicted_traj, predicted_trajs_all, thres=0.2):
-    '''
-    Input:
-        predicted_trajs: predicted trajectory of the primary agents, [12, 2]
-        predicted_trajs_all: predicted trajectory of all agents in the scene, [num_person, 12, 2]
-    '''
-    ph = predicted_traj.shape[0]
-    num_interp = 4
-    assert predicted_trajs_all.shape[0] > 1
-
-    dense_all = interpolate_traj(predicted_trajs_all, num_interp)
-    dense_ego = interpolate_traj(predicted_traj[None, :], num_interp)
-    distances = np.linalg.norm(dense_all - dense_ego, axis=-1)  # [num_person, 12 * num_interp]
-    mask = distances[:, 0] > 0  # exclude primary agent itself
-    return (distances[mask].min(axis=0) < thres)
-
-
-def test(KSTEPS=20):
-    global loader_test, model
+def test(model, device, loader_test, KSTEPS=20):
     model.eval()
     ade_bigls = []
     fde_bigls = []
@@ -74,28 +41,14 @@ def test(KSTEPS=20):
         # V_obs_tmp = batch,feat,seq,node
         V_obs_tmp = V_obs.permute(0, 3, 1, 2)
 
-        V_pred, _ = model(V_obs_tmp, A_obs.squeeze())
-        V_pred = V_pred.detach().permute(0, 2, 3, 1)
-        # torch.Size([1, 12, 2, 5])>>seq,node,feat
+        # KSTEPS sampled rollouts decoded as one batch, every step conditioned on the previous draw
+        with torch.no_grad():
+            kstep_V_pred, _ = model.rollout(V_obs_tmp, A_obs.squeeze(), V_tr.shape[1], KSTEPS) # [KSTEPS, 12, num_person, 2]
 
         V_tr = V_tr.squeeze()
-        V_pred = V_pred.squeeze()
         num_of_objs = obs_traj_rel.shape[1]
-        V_pred, V_tr = V_pred[:, :num_of_objs, :], V_tr[:, :num_of_objs, :]
-
-        # For now I have my bi-variate parameters
-        sx = torch.exp(V_pred[:, :, 2])  # sx
-        sy = torch.exp(V_pred[:, :, 3])  # sy
-        corr = torch.tanh(V_pred[:, :, 4])  # corr
-
-        cov = torch.zeros(V_pred.shape[0], V_pred.shape[1], 2, 2).to(device)
-        cov[:, :, 0, 0] = sx * sx
-        cov[:, :, 0, 1] = corr * sx * sy
-        cov[:, :, 1, 0] = corr * sx * sy
-        cov[:, :, 1, 1] = sy * sy
-        mean = V_pred[:, :, 0:2]
-
-        mvnormal = torchdist.MultivariateNormal(mean, cov)
+        V_tr = V_tr[:, :num_of_objs, :]
+        kstep_V_pred = kstep_V_pred[:, :, :num_of_objs, :]
 
         ### Rel to abs
         ##obs_traj.shape = torch.Size([1, 6, 2, 8]) Batch, Ped ID, x|y, Seq Len
@@ -107,11 +60,11 @@ def test(KSTEPS=20):
         coll_step_ls = {}
         V_x = seq_to_nodes(obs_traj.data.cpu().numpy().copy())
         V_x_rel_to_abs = nodes_rel_to_nodes_abs(V_obs.data.cpu().numpy().squeeze().copy(),
-                                                V_x[0, :, :].copy())
+                                                V_x[0, :, :].copy()).numpy()
 
         V_y = seq_to_nodes(pred_traj_gt.data.cpu().numpy().copy())
         V_y_rel_to_abs = nodes_rel_to_nodes_abs(V_tr.data.cpu().numpy().squeeze().copy(),
-                                                V_x[-1, :, :].copy())
+                                                V_x[-1, :, :].copy()).numpy()
 
         raw_data_dict[step] = {}
         raw_data_dict[step]['obs'] = copy.deepcopy(V_x_rel_to_abs)
@@ -126,10 +79,10 @@ def test(KSTEPS=20):
 
         for k in range(KSTEPS):
 
-            V_pred = mvnormal.sample()
+            V_pred = kstep_V_pred[k]
 
             V_pred_rel_to_abs = nodes_rel_to_nodes_abs(V_pred.data.cpu().numpy().squeeze().copy(),
-                                                       V_x[-1, :, :].copy())
+                                                       V_x[-1, :, :].copy()).numpy()
             raw_data_dict[step]['pred'].append(copy.deepcopy(V_pred_rel_to_abs))
 
             # print(V_pred_rel_to_abs.shape) #(12, 3, 2) = seq, ped, location
@@ -188,6 +141,8 @@ if __name__ == '__main__':
                         help='tag for csv path')
     parser.add_argument('--mode', type=str, default='fde',
                         help='metrics used to select model')
+    parser.add_argument('--quantize', action='store_true', default=False,
+                        help='also evaluate a dynamic INT8 copy of the model on CPU and report the deltas')
     ##Hos
     #############
     collision_thrshld = 0.2
@@ -258,16 +213,21 @@ if __name__ == '__main__':
                 num_workers=1)
 
             # Defining the model
+            # same architecture as train_b.config_model, args.pkl of older runs may miss the newer options
             model = SGTN(n_sstgcn=args.n_sstgcn, n_txpcnn=args.n_txpcnn,
                                   output_feat=args.output_size, seq_len=args.obs_seq_len,
-                                  kernel_size=args.kernel_size, pred_seq_len=args.pred_seq_len).to(device)
+                                  kernel_size=args.kernel_size, pred_seq_len=args.pred_seq_len,
+                                  emb_size=args.emb_size, fw=args.fw, heads=args.heads, layers=args.layers,
+                                  dropout=args.dropout, attn_backend=getattr(args, 'attn_backend', 'reference'),
+                                  fused_norm=getattr(args, 'fused_norm', False),
+                                  one_shot=getattr(args, 'one_shot', False)).to(device)
             model.load_state_dict(torch.load(model_path, map_location=device))
 
             ade_ = 999999
             fde_ = 999999
             coll_ = 999999
             print("Testing ....")
-            ad, fd, coll, coll_step, coll_cum, raw_data_dic_ = test()
+            ad, fd, coll, coll_step, coll_cum, raw_data_dic_ = test(model, device, loader_test, KSTEPS)
             ade_ = min(ade_, ad)
             fde_ = min(fde_, fd)
             coll_ = min(coll_, coll_cum[2])  # use the coll_joint_cum up to step 4 as the collision metric
@@ -276,6 +236,12 @@ if __name__ == '__main__':
             coll_ls.append(coll_)
             print("ADE:", ade_, " FDE:", fde_, " Coll:", coll_)
 
+            if opt.quantize:
+                def evaluate(cur_model):
+                    ad, fd, _, _, coll_cum, _ = test(cur_model, torch.device('cpu'), loader_test, KSTEPS)
+                    return ad, fd, coll_cum[2]
+                print(format_comparison(compare_quantized(evaluate, model)))
+
             df.loc[len(df)] = [args.dataset, ade_, fde_, coll_, 'model={:s}'.format(model_path)]
             time_elapsed = time.time() - time_start
             print('Elasped time: {:.2f} s'.format(time_elapsed))
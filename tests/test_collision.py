@@ -0,0 +1,140 @@
+import numpy as np
+import pytest
+
+from utils import compute_col_batch, swept_min_dist2
+
+
+def interpolate_traj_ref(traj, num_interp=4):
+    # interpolate_traj as it was before the batched collision check
+    sz = traj.shape
+    dense = np.zeros((sz[0], (sz[1] - 1) * (num_interp + 1) + 1, 2))
+    dense[:, :1, :] = traj[:, :1]
+    for i in range(num_interp+1):
+        ratio = (i + 1) / (num_interp + 1)
+        dense[:, i+1::num_interp+1, :] = traj[:, 0:-1] * (1 - ratio) + traj[:, 1:] * ratio
+    return dense
+
+
+def compute_col_pred_ref(predicted_traj, predicted_trajs_all, mask_nei, thres=0.2):
+    # compute_col_pred as it was before the batched collision check
+    dense_all = interpolate_traj_ref(predicted_trajs_all, 4)
+    dense_ego = interpolate_traj_ref(predicted_traj[None, :], 4)
+    distances = np.linalg.norm(dense_all - dense_ego, axis=-1)
+    distances = distances[mask_nei, :]
+    mask = distances[:, 0] > 0
+    if distances[mask].shape[0] == 0:
+        return np.repeat(False, dense_ego.shape[1])
+    return distances[mask].min(axis=0) < thres
+
+
+def compute_dist2_dense(rel, num_interp):
+    dense = interpolate_traj_ref(rel.reshape(-1, rel.shape[-2], 2), num_interp)
+    return (dense ** 2).sum(axis=-1).reshape(rel.shape[:-2] + (-1,))
+
+
+def random_scene(rng, K, N, dtype):
+    trajs = np.cumsum(rng.normal(0, 0.15, (K, N, 12, 2)), axis=2) + rng.normal(0, 0.5, (1, N, 1, 2))
+    return trajs.astype(dtype)
+
+
+@pytest.mark.parametrize('dtype', [np.float32, np.float64])
+def test_interpolated_matches_reference(dtype):
+    rng = np.random.default_rng(0)
+    for _ in range(20):
+        K, N = rng.integers(1, 5), rng.integers(2, 12)
+        trajs = random_scene(rng, K, N, dtype)
+        mask_nei = rng.random((N, N)) > 0.2
+        target = random_scene(rng, 1, N, dtype)
+        joint = compute_col_batch(trajs, trajs, mask_nei, exact=False)
+        cross = compute_col_batch(trajs, target, mask_nei, exact=False)
+        for k in range(K):
+            for n in range(N):
+                assert np.array_equal(joint[k, n], compute_col_pred_ref(trajs[k, n], trajs[k], mask_nei[n]))
+                assert np.array_equal(cross[k, n], compute_col_pred_ref(trajs[k, n], target[0], mask_nei[n]))
+
+
+def test_exact_is_superset_of_interpolated():
+    rng = np.random.default_rng(1)
+    for _ in range(20):
+        K, N = rng.integers(1, 5), rng.integers(2, 16)
+        trajs = random_scene(rng, K, N, np.float64)
+        mask_nei = rng.random((N, N)) > 0.2
+        interpolated = compute_col_batch(trajs, trajs, mask_nei, exact=False)
+        exact = compute_col_batch(trajs, trajs, mask_nei, exact=True)
+        assert not (interpolated & ~exact).any()
+
+
+def test_exact_matches_dense_sampling():
+    rng = np.random.default_rng(2)
+    rel = random_scene(rng, 3, 4, np.float64)
+    exact = swept_min_dist2(rel)
+    # 40 samples per sub-interval of the 56 step grid
+    fine = compute_dist2_dense(rel, 199)
+    sampled = np.concatenate([fine[..., :1]] + [fine[..., (j - 1) * 40:j * 40 + 1].min(axis=-1, keepdims=True)
+                                                for j in range(1, 56)], axis=-1)
+    assert (exact <= sampled + 1e-12).all()
+    assert np.allclose(exact, sampled, atol=1e-4)
+
+
+def test_crossing_between_interpolated_points():
+    # the agents meet at the origin halfway through the first interval, the interpolated points
+    # at 0.4 and 0.6 of it are still 0.28 apart
+    t = np.arange(12, dtype=np.float64)
+    ego = np.stack((-1 + 2 * t, np.zeros(12)), axis=-1)
+    other = np.stack((np.zeros(12), -1 + 2 * t), axis=-1)
+    trajs = np.stack((ego, other))[None] # [1, 2, 12, 2]
+    mask_nei = np.ones((2, 2), dtype=bool)
+
+    interpolated = compute_col_batch(trajs, trajs, mask_nei, exact=False)
+    exact = compute_col_batch(trajs, trajs, mask_nei, exact=True)
+    assert not interpolated.any()
+    assert exact[0, :, 3].all()
+    assert exact.sum() == 2
+
+
+def boundary_scene(thres, K=3):
+    # stationary and moving pairs exactly thres apart, and just inside it, along x, y and the diagonal
+    t = np.linspace(0, 1, 12)[:, None]
+    agents = []
+    for offset, gap in enumerate([thres, np.nextafter(thres, 0), thres * (1 - 1e-9)]):
+        base = np.array([10.0 * offset, 0.0])
+        agents.append(np.broadcast_to(base, (12, 2)))
+        agents.append(np.broadcast_to(base + [gap, 0.0], (12, 2)))
+        agents.append(np.broadcast_to(base + [0.0, gap], (12, 2)))
+        agents.append(base + [0.0, 5.0] + t * [1.0, 0.0])
+        agents.append(base + [1.0 + gap, 5.0] + t * [1.0, 0.0])
+        agents.append(base + [3.0, 3.0] + gap / np.sqrt(2) * np.ones(2) + t * [0.0, 0.5])
+        agents.append(base + [3.0, 3.0] + t * [0.0, 0.5])
+    trajs = np.stack(agents)[None] # [1, N, 12, 2]
+    # the samples are shifted apart inside compute_col_batch, give them different extents too
+    return np.concatenate([trajs + 100.0 * k for k in range(K)])
+
+
+@pytest.mark.parametrize('exact', [False, True])
+@pytest.mark.parametrize('thres', [0.2, 0.25])
+def test_broad_phase_matches_all_pairs(exact, thres):
+    rng = np.random.default_rng(3)
+    scenes = [boundary_scene(thres)]
+    for _ in range(20):
+        K, N = rng.integers(1, 6), rng.integers(1, 20)
+        scenes.append(random_scene(rng, K, N, np.float64))
+        scenes.append(np.round(random_scene(rng, K, N, np.float64), 1)) # ties and repeated coordinates
+
+    for trajs in scenes:
+        K, N = trajs.shape[:2]
+        mask_nei = rng.random((N, N)) > 0.2
+        # self: predictions against predictions
+        assert np.array_equal(compute_col_batch(trajs, trajs, mask_nei, thres, exact=exact, broad_phase=True),
+                              compute_col_batch(trajs, trajs, mask_nei, thres, exact=exact, broad_phase=False))
+        # cross: predictions against one shared ground truth and against per sample trajectories
+        for other in [trajs[:1] + rng.normal(0, 0.1, trajs[:1].shape), trajs[::-1]]:
+            assert np.array_equal(compute_col_batch(trajs, other, mask_nei, thres, exact=exact, broad_phase=True),
+                                  compute_col_batch(trajs, other, mask_nei, thres, exact=exact, broad_phase=False))
+
+
+def test_boundary_scene_has_collisions():
+    # guards the boundary scene above against testing only empty masks
+    trajs = boundary_scene(0.2)
+    mask_nei = np.ones(trajs.shape[1:2] * 2, dtype=bool)
+    col = compute_col_batch(trajs, trajs, mask_nei, 0.2, exact=True, broad_phase=False)
+    assert col.any() and not col.all()
@@ -0,0 +1,98 @@
+import logging
+import os
+
+import numpy as np
+import torch
+
+from eval_pool import EvalContext, EvalExecutor, _views
+from utils import evaluate_ksteps
+
+
+class SceneSet(object):
+    # stands in for a DataLoader over a TrajectoryDataset, only data_dir and the batches are used
+    def __init__(self, data_dir, batches):
+        self.dataset = type('Dataset', (), {'data_dir': data_dir})()
+        self.batches = batches
+
+    def __len__(self):
+        return len(self.batches)
+
+    def __iter__(self):
+        return iter(self.batches)
+
+
+def make_batches(seed, num_batch=3, N=4):
+    g = torch.Generator().manual_seed(seed)
+    batches = []
+    for _ in range(num_batch):
+        obs = torch.randn(1, N, 2, 8, generator=g)
+        V_tr = torch.randn(1, 12, N, 2, generator=g) * 0.1
+        A = torch.ones(1, 8, N, N)
+        batches.append((obs, None, obs, None, None, None, None, A, V_tr, None))
+    return batches
+
+
+def test_cache_is_rebuilt_when_stale(tmp_path, caplog):
+    data_file = tmp_path / 'scenes.txt'
+    data_file.write_text('a')
+    cache_path = str(tmp_path / 'eval_context_8_12.pt')
+    loader = SceneSet(str(tmp_path), make_batches(0))
+    device = torch.device('cpu')
+
+    built = EvalContext(loader, device, cache_path)
+    assert os.path.exists(cache_path)
+    with caplog.at_level(logging.INFO):
+        loaded = EvalContext(loader, device, cache_path)
+    assert 'Loaded evaluation context' in caplog.text
+    assert torch.equal(built.targets[0], loaded.targets[0])
+
+    # same batch count, regenerated dataset
+    loader = SceneSet(str(tmp_path), make_batches(1))
+    data_file.write_text('bb')
+    caplog.clear()
+    with caplog.at_level(logging.INFO):
+        rebuilt = EvalContext(loader, device, cache_path)
+    assert 'stale' in caplog.text
+    data = EvalContext.build(loader)
+    assert torch.equal(rebuilt.targets[0], _views(data['target_buffer'], data['target_shapes'])[0])
+
+    # different collision settings
+    for kwargs in [{'exact_col': True}, {'thres': 0.3}, {'num_interp': 2}]:
+        caplog.clear()
+        with caplog.at_level(logging.INFO):
+            EvalContext(loader, device, cache_path, **kwargs)
+        assert 'stale' in caplog.text
+
+
+def test_context_is_shared_only_on_request():
+    loader = SceneSet(None, make_batches(0, num_batch=5))
+    device = torch.device('cpu')
+    context = EvalContext(loader, device)
+    assert not any(target.is_shared() for target in context.targets)
+    assert not any(mask.is_shared() for mask in context.masks)
+
+    context = EvalContext(loader, device, share=True)
+    # one storage, hence one open file descriptor, per kind for the whole loader
+    assert all(target.is_shared() for target in context.targets + context.masks)
+    assert len({target.untyped_storage().data_ptr() for target in context.targets}) == 1
+    assert len({mask.untyped_storage().data_ptr() for mask in context.masks}) == 1
+
+
+def test_stream_uses_the_context_collision_settings():
+    loader = SceneSet(None, make_batches(0))
+    device = torch.device('cpu')
+    g = torch.Generator().manual_seed(2)
+    for kwargs in [{}, {'thres': 0.3, 'num_interp': 2}]:
+        context = EvalContext(loader, device, **kwargs)
+        stream = EvalExecutor(workers=0).stream(compute_col_truth=True, truth=context.truth, **context.col_args)
+        for target, mask in zip(context.targets, context.masks):
+            pred = target[None] + torch.randn(3, *target.shape, generator=g) * 0.1
+            stream.add(pred, target, mask)
+            joint = evaluate_ksteps(pred.numpy(), target.numpy(), mask.numpy(), **context.col_args)[3]
+            assert joint.shape[1] == 11 * (context.col_args['num_interp'] + 1) + 1
+        summary = stream.result().summary()
+        for curve in summary[3:]:
+            assert curve.shape == (11,)
+        # the truth curves of the context are those of its own settings
+        fresh = EvalContext(loader, device, **kwargs).truth.result()
+        assert np.array_equal(summary[7], fresh[0])
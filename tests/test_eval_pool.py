@@ -0,0 +1,43 @@
+import numpy as np
+import torch
+
+from eval_pool import EvalExecutor, _pack
+
+
+def make_scenes(seed, num_batch=6, ksteps=3):
+    g = torch.Generator().manual_seed(seed)
+    scenes = []
+    for b in range(num_batch):
+        N = 2 + b % 3
+        target = torch.randn(12, N, 2, generator=g)
+        pred = target[None] + torch.randn(ksteps, 12, N, 2, generator=g) * 0.1
+        mask = torch.rand(N, N, generator=g) > 0.3
+        scenes.append((pred, target, mask))
+    return scenes
+
+
+def test_pack_uses_one_shared_buffer():
+    preds, targets, masks = zip(*make_scenes(0))
+    packed = _pack(preds)
+    assert all(pred.is_shared() for pred in packed)
+    assert len({pred.untyped_storage().data_ptr() for pred in packed}) == 1
+    for pred, original in zip(packed, preds):
+        assert torch.equal(pred, original)
+    # numpy input and tensors that are shared already
+    assert np.array_equal(_pack([mask.numpy() for mask in masks])[1].numpy(), masks[1].numpy())
+    assert all(a is b for a, b in zip(_pack(packed), packed))
+
+
+def test_workers_match_in_process():
+    scenes = make_scenes(1)
+    summaries = []
+    for workers in [0, 1]:
+        executor = EvalExecutor(workers=workers)
+        stream = executor.stream(compute_col_truth=True, chunk=4, ks=[1, 3])
+        for pred, target, mask in scenes:
+            stream.add(pred, target, mask)
+        summaries.append(stream.result().summaries())
+        executor.shutdown()
+    for K in [1, 3]:
+        for a, b in zip(summaries[0][K], summaries[1][K]):
+            assert np.array_equal(np.asarray(a), np.asarray(b))
@@ -0,0 +1,43 @@
+import numpy as np
+import pytest
+import torch
+
+from metrics import displacement_error, ade, fde, horizons_from_seconds, CAR_HORIZONS
+
+
+def displacement_error_ref(predAll, targetAll, count_=None):
+    # ragged displacement_error as it was with the per scene loop
+    if count_ is None:
+        count_ = [pred.shape[1] for pred in predAll]
+    diff = np.zeros((len(predAll), predAll[0].shape[0], max(count_), 2))
+    for s, (pred, target) in enumerate(zip(predAll, targetAll)):
+        diff[s, :, :count_[s]] = np.asarray(pred)[:, :count_[s]] - np.asarray(target)[:, :count_[s]]
+    return np.linalg.norm(diff, axis=-1), np.asarray(count_)
+
+
+@pytest.mark.parametrize('count_', [None, [2, 1, 5, 2], [3, 0, 7, 1]])
+def test_ragged_matches_loop(count_):
+    rng = np.random.default_rng(0)
+    sizes = [3, 1, 7, 2]
+    predAll = [rng.normal(size=(12, n, 2)).astype(np.float32) for n in sizes]
+    targetAll = [rng.normal(size=(12, n, 2)).astype(np.float32) for n in sizes]
+
+    error, count = displacement_error(predAll, targetAll, count_)
+    error_ref, count_ref = displacement_error_ref(predAll, targetAll, count_)
+    np.testing.assert_array_equal(error, error_ref)
+    np.testing.assert_array_equal(count, count_ref)
+
+    # tensors go through the same path
+    tensors = displacement_error([torch.tensor(p) for p in predAll], [torch.tensor(t) for t in targetAll], count_)
+    np.testing.assert_array_equal(tensors[0], error_ref)
+
+    if count_ is None or min(count_) > 0:
+        assert ade(predAll, targetAll, count_) == pytest.approx(
+            np.mean([error_ref[s, :, :c].mean() for s, c in enumerate(count_ref)]))
+        assert fde(predAll, targetAll, count_) == pytest.approx(
+            np.mean([error_ref[s, -1, :c].mean() for s, c in enumerate(count_ref)]))
+
+
+def test_horizons_from_seconds():
+    assert horizons_from_seconds([1, 2, 3, 4, 5], 5) == list(CAR_HORIZONS)
+    assert horizons_from_seconds([0.5, 1.5], 10) == [4, 14]
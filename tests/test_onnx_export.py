@@ -0,0 +1,25 @@
+import pytest
+import torch
+
+pytest.importorskip('onnx')
+pytest.importorskip('onnxruntime')
+
+from model import SGTN
+from onnx_export import export_onnx, OnnxSGTN, check_parity
+
+
+def test_onnx_matches_torch(tmp_path):
+    torch.manual_seed(0)
+    model = SGTN(n_sstgcn=2, seq_len=8, pred_seq_len=12, emb_size=16, fw=16, heads=2, layers=2).eval()
+    encoder_path, decoder_path = str(tmp_path / 'encoder.onnx'), str(tmp_path / 'decoder_step.onnx')
+    export_onnx(model, encoder_path, decoder_path, num_person=6)
+
+    runtime = OnnxSGTN(encoder_path, decoder_path)
+    # agent counts other than the exported one go through the dynamic axes
+    for num_person in [3, 6, 11]:
+        diffs = check_parity(model, runtime, num_person=num_person)
+        for name, diff in diffs.items():
+            assert diff < 1e-4, (num_person, name, diff)
+
+    traj = runtime.rollout(torch.randn(1, 2, 8, 4).numpy(), torch.rand(8, 4, 4).numpy(), 12, ksteps=5, seed=0)
+    assert traj.shape == (5, 12, 4, 2)
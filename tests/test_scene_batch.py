@@ -0,0 +1,89 @@
+import copy
+
+import pytest
+import torch
+
+from metrics import bivariate_loss
+from model_b import SGTN, MaskedBatchNorm2d
+from utils import collate_scenes
+
+
+def make_scene(g, N):
+    # the 10 fields of a val/test TrajectoryDataset item
+    obs = torch.randn(N, 2, 8, generator=g)
+    pred = torch.randn(N, 2, 12, generator=g)
+    A_obs = torch.rand(8, N, N, generator=g) + torch.eye(N)
+    A_tr = torch.rand(12, N, N, generator=g)
+    return [obs, pred, obs.clone(), pred.clone(), torch.zeros(N), torch.ones(N, 20),
+            obs.permute(2, 0, 1).contiguous(), A_obs, pred.permute(2, 0, 1).contiguous(), A_tr]
+
+
+def make_model(attnaj):
+    torch.manual_seed(0)
+    model = SGTN(n_sstgcn=2, seq_len=8, pred_seq_len=12, emb_size=16, fw=16, heads=2, layers=1, dropout=0.0,
+                 attnaj=attnaj).train()
+    # the attention dropout does not follow the dropout argument, draws would differ between batch shapes
+    for module in model.modules():
+        if isinstance(module, torch.nn.Dropout):
+            module.p = 0.0
+    return model
+
+
+def run(model, V_obs, A_obs, V_tr, agent_mask=None):
+    v = V_obs.permute(0, 3, 1, 2) # [bs, 2, 8, num_person]
+    v_t = torch.cat((v[:, :, -1:], V_tr.permute(0, 3, 1, 2)[:, :, :-1]), 2) # [bs, 2, 12, num_person]
+    return model(v, A_obs, v_t, -1, 0, None, agent_mask) # [bs, 5, 12, num_person]
+
+
+def block_diagonal(scenes):
+    # the scenes packed as one bigger scene, the way the loaders batch without a batch dimension
+    V_obs = torch.cat([scene[6] for scene in scenes], 1)[None]
+    V_tr = torch.cat([scene[8] for scene in scenes], 1)[None]
+    A_obs = torch.stack([torch.block_diag(*[scene[7][t] for scene in scenes]) for t in range(8)])[None]
+    return V_obs, A_obs, V_tr
+
+
+@pytest.mark.parametrize('attnaj', [0, 2])
+def test_padding_does_not_change_real_agents(attnaj):
+    g = torch.Generator().manual_seed(0)
+    scene = make_scene(g, 3)
+    model = make_model(attnaj)
+
+    reference = copy.deepcopy(model)
+    expected = run(reference, scene[6][None], scene[7][None], scene[8][None])
+
+    # only the first scene: a batch of one, padded to 5 agents
+    batch = collate_scenes([scene] + [make_scene(g, 5)])
+    padded = [field[:1] for field in batch]
+    padded[-1] = batch[-1][:1]
+    out = run(model, padded[6], padded[7], padded[8], padded[-1])
+
+    assert out.shape[-1] == 5
+    assert torch.allclose(out[..., :3], expected, atol=1e-5)
+    assert torch.all(out[..., 3:] == 0)
+    for norm, norm_ref in zip(model.modules(), reference.modules()):
+        if isinstance(norm, MaskedBatchNorm2d):
+            assert torch.allclose(norm.running_mean, norm_ref.running_mean, atol=1e-6)
+            assert torch.allclose(norm.running_var, norm_ref.running_var, atol=1e-6)
+
+
+@pytest.mark.parametrize('attnaj', [0, 2])
+def test_scene_batch_matches_block_diagonal(attnaj):
+    g = torch.Generator().manual_seed(1)
+    scenes = [make_scene(g, N) for N in [3, 5, 2]]
+    model = make_model(attnaj)
+
+    reference = copy.deepcopy(model)
+    expected = run(reference, *block_diagonal(scenes))[0] # [5, 12, 10]
+
+    batch = collate_scenes(scenes)
+    agent_mask = batch[-1]
+    out = run(model, batch[6], batch[7], batch[8], agent_mask) # [3, 5, 12, 5]
+    real = out.permute(1, 2, 0, 3)[:, :, agent_mask] # [5, 12, 10]
+    assert torch.allclose(real, expected, atol=1e-5)
+
+    # the masked loss only counts the real agents
+    V_pred = out.permute(0, 2, 3, 1) # [3, 12, 5, 5]
+    loss = bivariate_loss(V_pred, batch[8], agent_mask[:, None, :])
+    loss_ref = bivariate_loss(expected.permute(1, 2, 0), torch.cat([scene[8] for scene in scenes], 1))
+    assert torch.allclose(loss, loss_ref, atol=1e-5)
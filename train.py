@@ -9,7 +9,6 @@ import random
 import torch
 import time
 import torch.nn.functional as F
-import torch.distributions.multivariate_normal as torchdist
 from tqdm.auto import tqdm
 
 from utils import * 
@@ -40,10 +39,16 @@ def parse_args():
 
     parser.add_argument('--num_epochs', type=int, default=100)
     parser.add_argument('--clip_grad', type=float, default=None)
+    parser.add_argument('--bf16', action='store_true', default=False,
+                        help='run the model under CPU bf16 autocast, the loss stays in FP32')
     parser.add_argument('--KSTEPS',type=int, default=20)
+    parser.add_argument('--horizons', type=float, nargs='+', default=[1, 2, 3, 4, 5],
+                        help='horizons in seconds reported for car')
+    parser.add_argument('--fps', type=float, default=5,
+                        help='frame rate of the car data, turns --horizons into step indices')
 
     parser.add_argument('--modelType',type=int, default=1) # 
-    parser.add_argument('--attnNei',type=int, default=0) # 
+    parser.add_argument('--attnNei',type=int, default=0) # 0: A as is, 1: legacy 64-agent re-weighting, 2: AdaptiveAdjacency (any k)
     parser.add_argument('--newTrans',type=int, default=0) # 
 
     parser.add_argument('--num_sstgcn', type=int, default=1)
@@ -58,6 +63,10 @@ def parse_args():
     parser.add_argument('--fw',type=int, default=32)
 
     args = parser.parse_args()
+    steps = horizons_from_seconds(args.horizons, args.fps)
+    if args.dataset == 'car' and not all(0 <= step < args.pred_seq_len for step in steps):
+        parser.error('--horizons {} at --fps {} are steps {}, outside the {} predicted steps'.format(
+            args.horizons, args.fps, steps, args.pred_seq_len))
     return args
 
 
@@ -106,7 +115,8 @@ def set_seed(seed):
 def copy_source(file, output_dir):
     shutil.copyfile(file, os.path.join(output_dir, os.path.basename(file)))
 
-def get_dataloader(params, logger):
+def get_dataloader(params, logger, batch_size=1, collate_fn=None):
+    # batch_size > 1 needs collate_fn=collate_scenes, the scenes have different agent counts
     data_set = '../../../scratch/data/SGTN/datasets/' + params.dataset + '/'
 
     dset_train = TrajectoryDataset(
@@ -121,9 +131,9 @@ def get_dataloader(params, logger):
 
     loader_train = DataLoader(
         dset_train,
-        batch_size=1,  
+        batch_size=batch_size,
         shuffle=True,
-        num_workers=6, pin_memory=True)
+        num_workers=6, pin_memory=True, collate_fn=collate_fn)
     
     dset_val = TrajectoryDataset(
         data_dir=data_set + 'val/',
@@ -137,9 +147,9 @@ def get_dataloader(params, logger):
     
     loader_val = DataLoader(
         dset_val,
-        batch_size=1,  
+        batch_size=batch_size,
         shuffle=True,
-        num_workers=6, pin_memory=True)
+        num_workers=6, pin_memory=True, collate_fn=collate_fn)
 
     dset_test = TrajectoryDataset(
         data_dir=data_set + 'test/',
@@ -153,9 +163,9 @@ def get_dataloader(params, logger):
 
     loader_test = DataLoader(
         dset_test,
-        batch_size=1,  
+        batch_size=batch_size,
         shuffle=False,
-        num_workers=6, pin_memory=True)
+        num_workers=6, pin_memory=True, collate_fn=collate_fn)
 
 
     return loader_train, loader_val, loader_test
@@ -195,7 +205,9 @@ def train(model, optimizer, device, loader_train, args):
         V_tr_tmp_start = V_obs_tmp[:,:,-1:,:]
         V_tr_tmp = torch.cat((V_tr_tmp_start, V_tr_tmp[:,:,:-1,:]),dim=2) # [1, 2, 12, num_person]
         
-        V_pred= model(V_obs_tmp, A_obs_tmp, V_tr_tmp, -1, V_tr_tmp)  # [1, 5, 12, num_person], [1, num_person, 60]
+        with cpu_autocast(args.bf16):
+            V_pred= model(V_obs_tmp, A_obs_tmp, V_tr_tmp, -1, V_tr_tmp)  # [1, 5, 12, num_person], [1, num_person, 60]
+        V_pred = V_pred.float()
 
         V_pred = V_pred.permute(0, 2, 3, 1)  # [1, 12, num_person, 5] <- [1, 5, 12, num_person]
 
@@ -222,7 +234,7 @@ def val_test(model, device, loader, KSTEPS=20):
     batch_count = 0
     num_batch = len(loader)
 
-    disbiglist = []
+    horizon = HorizonAccumulator()
 
     for step, batch in enumerate(loader):
         batch_count += 1
@@ -244,9 +256,14 @@ def val_test(model, device, loader, KSTEPS=20):
         V_tr_tmp_start = V_obs_tmp[:,:,-1:,:]
         V_tr_tmp = V_tr_tmp_start # [1, 2, 1, num_person]
 
-        V_pred = model(V_obs_tmp, A_obs_tmp, V_tr_tmp, 0, V_tr_tmp)
+        # the graph and encoder stack only see the observed history, run them once per scene
+        memory, src_att, _ = model.encode(V_obs_tmp, A_obs_tmp)
+
+        V_pred = model.decode_step(memory, src_att, V_tr_tmp) #  [1, 5, 1, num_person]
         for i in range(1,V_tr.shape[1]):
-            V_pred = model(V_obs_tmp, A_obs_tmp, V_tr_tmp, i, V_pred) #  [1, 5, 1, num_person]
+            # feed the predicted mean of the last step back in
+            V_tr_tmp = torch.cat((V_tr_tmp, V_pred[:, :2, -1:, :]), 2) # [1, 2, i+1, num_person]
+            V_pred = model.decode_step(memory, src_att, V_tr_tmp) #  [1, 5, i+1, num_person]
 
         V_pred = V_pred.permute(0, 2, 3, 1) #  [1, 12, num_person, 5]]
 
@@ -257,45 +274,14 @@ def val_test(model, device, loader, KSTEPS=20):
         loss_task = graph_loss(V_pred,V_tr)
         loss_batch += loss_task.item()
 
-        sx = torch.exp(V_pred[:, :, 2])  # sx
-        sy = torch.exp(V_pred[:, :, 3])  # sy
-        corr = torch.tanh(V_pred[:, :, 4])  # corr
-
-        cov = torch.zeros(V_pred.shape[0], V_pred.shape[1], 2, 2).to(device)
-        cov[:, :, 0, 0] = sx * sx
-        cov[:, :, 0, 1] = corr * sx * sy
-        cov[:, :, 1, 0] = corr * sx * sy
-        cov[:, :, 1, 1] = sy * sy
-        mean = V_pred[:, :, 0:2]
-
-        mvnormal = torchdist.MultivariateNormal(mean, cov)
-        kstep_V_pred_ls = []
-        for i in range(KSTEPS):
-            kstep_V_pred_ls.append(mvnormal.sample().cpu().numpy())  # cat [12, num_person, 2]
-        kstep_V_pred_ls = np.stack(kstep_V_pred_ls, axis=0) # [KSTEPS, 12, num_person, 2]
-
-
-        start = seq_to_nodes(obs_traj.data.cpu().numpy())[-1, :, :] # [8, num_person, 2]
-        V_y_rel_to_abs = nodes_rel_to_nodes_abs(V_tr.data.cpu().numpy().squeeze(), start) # [12, num_person, 2] torch.Size([25, 64, 2]) torch.Size([64, 2])
-        V_y_rel_to_abs =V_y_rel_to_abs.repeat(KSTEPS,1,1,1) #torch.Size([20, 25, 64, 2])
-        dislist = [] 
-
-        for i in range(V_y_rel_to_abs.size()[1]):
-            thispredrel = torch.tensor(kstep_V_pred_ls[:,i,:,:]).to(device)
-            thispred = thispredrel +torch.tensor(start).to(device)
-            thisgt = torch.tensor(V_y_rel_to_abs[:,i,:,:]).to(device)
-            distance = F.pairwise_distance(thispred, thisgt, p=2)
-            index=torch.argmin(distance,dim=0)
-            indexNext=index.reshape(1,index.size()[0],1).repeat(1,1,2)
-            next=torch.gather(thispred, 0, indexNext) #[-1, num_person, 2]
-            start=next.squeeze()
-            indexDis=index.reshape(1,index.size()[0])
-            disres=torch.gather(distance, 0, indexDis).squeeze() #[-1, num_person, 2]
-            disres = disres.sum()/len(disres)
-            dislist.append(disres)
-        disbiglist.append(dislist)
-
-    final=np.sum(disbiglist,axis=0)/num_batch
+        kstep_V_pred = sample_bivariate(V_pred, KSTEPS) # [KSTEPS, 12, num_person, 2]
+
+        # everything below stays on device, one sync per epoch when final is read
+        start = seq_to_nodes_torch(obs_traj)[-1] # [num_person, 2]
+        V_y_rel_to_abs = nodes_rel_to_nodes_abs_torch(V_tr, start) # [12, num_person, 2]
+        horizon.update(best_of_k_chain(kstep_V_pred, start, V_y_rel_to_abs)[:, None]) # one [12] mean per batch
+
+    final=horizon.result()
     loss=loss_batch/batch_count
     return loss, final
 
@@ -305,24 +291,7 @@ def sample_pred(V_pred, V_tr, i, KSTEPS):
     V_pred = V_pred.permute(0, 2, 3, 1) #  [1, 12, num_person, 5]]
     V_pred = V_pred[:,-1:,:,:]
     V_pred = V_pred.squeeze(0) #  [-1, num_person, 5]
-    # For now I have my bi-variate parameters
-    sx = torch.exp(V_pred[:, :, 2])  # sx
-    sy = torch.exp(V_pred[:, :, 3])  # sy
-    corr = torch.tanh(V_pred[:, :, 4])  # corr
-
-    cov = torch.zeros(V_pred.shape[0], V_pred.shape[1], 2, 2).to(device)
-    cov[:, :, 0, 0] = sx * sx
-    cov[:, :, 0, 1] = corr * sx * sy
-    cov[:, :, 1, 0] = corr * sx * sy
-    cov[:, :, 1, 1] = sy * sy
-    mean = V_pred[:, :, 0:2]
-
-    mvnormal = torchdist.MultivariateNormal(mean, cov)
-
-    kstep_V_pred_ls = []
-    for j in range(KSTEPS):
-        kstep_V_pred_ls.append(mvnormal.sample())  # cat [-1, num_person, 2]
-    kstep_V_pred = torch.cat(kstep_V_pred_ls,dim=0) #[1*20, num_person, 2]
+    kstep_V_pred = sample_bivariate(V_pred, KSTEPS).reshape(-1, V_pred.shape[1], 2) #[1*20, num_person, 2]
     
     V_this = V_tr.squeeze()[i:i+1,:,:] #[1, num_person, 2]
 
@@ -340,7 +309,7 @@ def val(model, device, loader, KSTEPS=20):
     batch_count = 0
 
     num_batch = len(loader)
-    V_pred_rel_to_abs_ksteps_ls, V_y_rel_to_abs_ls, mask_ls = [None] * num_batch, [None] * num_batch, [None] * num_batch
+    horizon = HorizonAccumulator(p=3)
 
     for step, batch in enumerate(loader):
         batch_count += 1
@@ -363,8 +332,10 @@ def val(model, device, loader, KSTEPS=20):
         V_tr_tmp = V_tr_tmp_start # [1, 2, 1, num_person]
 
 
+        memory, src_att, _ = model.encode(V_obs_tmp, A_obs_tmp)
+
         for i in range(V_tr.shape[1]):
-            V_pred = model(V_obs_tmp, A_obs_tmp, V_tr_tmp, -1, V_tr_tmp) #  [1, 5, 1, num_person]
+            V_pred = model.decode_step(memory, src_att, V_tr_tmp) #  [1, 5, 1, num_person]
             output=  sample_pred(V_pred, V_tr, i, KSTEPS) #  [-1, num_person, 2]
             output = output.permute(2,0,1).unsqueeze(0)
             V_tr_tmp = torch.cat((V_tr_tmp, output), 2) # torch.Size([1, 2, 26, 64])
@@ -378,17 +349,15 @@ def val(model, device, loader, KSTEPS=20):
         loss_task = graph_loss(V_pred,V_tr)
         loss_batch += loss_task.item()
 
-        V_x = seq_to_nodes(obs_traj.data.cpu().numpy()) # [8, num_person, 2]
-        V_y_rel_to_abs = nodes_rel_to_nodes_abs(V_tr.data.cpu().numpy().squeeze(), V_x[-1, :, :]) # [12, num_person, 2] speed??? torch.Size([25, 64, 2])
-        V_pred_rel_to_abs = nodes_rel_to_nodes_abs(V_tr_tmp.squeeze().permute(1,2,0)[1:,:,:].data.cpu().numpy(), V_x[-1, :, :]) # torch.Size([25, 64, 2])
+        V_x = seq_to_nodes_torch(obs_traj) # [8, num_person, 2]
+        V_y_rel_to_abs = nodes_rel_to_nodes_abs_torch(V_tr, V_x[-1]) # [12, num_person, 2]
+        V_pred_rel_to_abs = nodes_rel_to_nodes_abs_torch(V_tr_tmp[0, :, 1:].permute(1, 2, 0), V_x[-1]) # [12, num_person, 2]
 
-        V_pred_rel_to_abs_ksteps_ls[step] = V_pred_rel_to_abs  # np.ndarray
-        V_y_rel_to_abs_ls[step] = V_y_rel_to_abs  # np.ndarray
+        horizon.update(V_pred_rel_to_abs, V_y_rel_to_abs)
 
     
     loss=loss_batch/batch_count
-    distance = F.pairwise_distance(torch.stack(V_pred_rel_to_abs_ksteps_ls), torch.stack(V_y_rel_to_abs_ls), p=3)
-    final = torch.sum(torch.sum(distance,dim=0),dim=1)/(distance.size()[0]*distance.size()[2])
+    final = horizon.result()
 
     return loss,final
 
@@ -457,10 +426,11 @@ def main():
         logger.info('Time to test once: {:.2f} s for dataset {:s}'.format(time_elapsed, args.dataset))
 
         if (args.dataset=='car'):
-            logger.info("dis1: {:.4f}, dis2: {:.4f}, dis3: {:.4f}, dis4: {:.4f}, dis5: {:.4F}".format(final[4],final[9],final[14],final[19], final[24]))
-            if(final[24]<disbig):
+            dis = final[horizons_from_seconds(args.horizons, args.fps)].tolist()
+            logger.info(", ".join("dis{:d}: {:.4f}".format(i + 1, d) for i, d in enumerate(dis)))
+            if(dis[-1]<disbig):
                 best_epoch = epoch
-                disbig = final[24]
+                disbig = dis[-1]
         else:
             logger.info("ade: {:.4f}, fde: {:.4f}".format(sum(final)/12,final[-1]))
             if(final[-1]<disbig):
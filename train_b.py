@@ -6,12 +6,11 @@ import pickle
 import argparse
 import random
 import shutil
+import copy
 import torch
 import torch.nn.functional as F
 import baselineUtils
 
-import torch.distributions.multivariate_normal as torchdist
-import torch.multiprocessing as multiprocessing
 
 from utils import * 
 from metrics import *
@@ -21,6 +20,8 @@ from contrast.model import *
 from contrast.contrastive import *
 
 from transformer.noam_opt import NoamOpt
+from quantize import compare_quantized, format_comparison
+from eval_pool import EvalExecutor, EvalContext, default_workers
 
 # random_seed = 2021
 # random.seed(random_seed)
@@ -102,17 +103,20 @@ def train(model, contrastive, optimizer, device, loader_train, epoch, metrics, a
         V_tr_tmp = torch.cat((V_tr_tmp_start, V_tr_tmp[:,:,1:,:]),dim=2) # [1, 2, 12, num_person]
         
         
-        V_pred, _, feat_vec = model(V_obs_tmp, A_obs_tmp, V_tr_tmp, return_feat=True)  # [1, 5, 12, num_person], [1, num_person, 60]
+        # the contrastive head only runs when its loss is used
+        with cpu_autocast(args.bf16):
+            V_pred, feat_vec, _ = model.train_step(V_obs_tmp, A_obs_tmp, V_tr_tmp, return_feat=args.contrast_weight > 0)  # [1, 5, 12, num_person], [num_person, 60]
+        V_pred = V_pred.float()
 
         V_pred = V_pred.permute(0, 2, 3, 1)  # [1, 12, num_person, 5] <- [1, 5, 12, num_person]
-        feat_vec = feat_vec.squeeze(0)  # [num_person, 60]
 
         V_tr = V_tr.squeeze()
         A_tr = A_tr.squeeze()
         V_pred = V_pred.squeeze()
 
-        V_pred = V_pred[:, safety_gt, :].contiguous()
-        V_tr = V_tr[:, safety_gt, :].contiguous()
+        if pick_safe_traj:
+            V_pred = V_pred[:, safety_gt, :]
+            V_tr = V_tr[:, safety_gt, :]
         loss_task = graph_loss(V_pred, V_tr)
         loss_contrast = torch.tensor(0.0).float().to(device)
 
@@ -128,6 +132,7 @@ def train(model, contrastive, optimizer, device, loader_train, epoch, metrics, a
             mask[:,:]=mask_graph[mask_temp].reshape(64,63).type(torch.BoolTensor)
 
             # replicate the scene such that each agent is primary for once
+            feat_vec = feat_vec.float()
             num_person = feat_vec.size(0) # torch.Size([64, 60])
             num_neighbors = num_person - 1
 
@@ -143,7 +148,9 @@ def train(model, contrastive, optimizer, device, loader_train, epoch, metrics, a
                 neg_seeds_tmp = pred_traj_gt[0, np.ix_(neighbor_idxes), :, :args.contrast_horizon].squeeze(0)  # [num_person-1, 2, H]
                 neg_seeds[idx_primary] = neg_seeds_tmp.permute(2, 0, 1)  # [H, num_person-1, 2]
 
-            hist_traj = V_obs_tmp.permute(3, 2, 1, 0).reshape(num_person, -1).contiguous()  # [num_person, 16] <- [1, 2, 8, num_person]
+            # the projection head is sized for the raw observed coordinates (obs_seq_len*2), not the encoder
+            # memory [num_person, 8, emb_size] that train_step returns, so the history stays a plain reshape
+            hist_traj = V_obs_tmp.permute(3, 2, 1, 0).reshape(num_person, -1)  # [num_person, 16] <- [1, 2, 8, num_person]
             l_contrast = contrastive.loss(pedestrain_states, mask, pos_seeds, neg_seeds, feat_vec, hist_traj)
             # 64*6 64*63 64*4*2 64*4*63*2 64*60 64*16
             loss_contrast += l_contrast * args.contrast_weight
@@ -171,18 +178,17 @@ def train(model, contrastive, optimizer, device, loader_train, epoch, metrics, a
     metrics['contrast_loss'].append(loss_contrast_batch/batch_count)
     
 
-def vald(model, device, loader_val, epoch, metrics, constant_metrics, args):
+def vald(model, device, loader_val, epoch, metrics, constant_metrics, args, executor=None, context=None):
     model.eval()
     loss_batch = 0
     batch_count = 0
 
     num_batch = len(loader_val)
-    V_pred_rel_to_abs_ksteps_ls, V_y_rel_to_abs_ls, mask_ls = [None] * num_batch, [None] * num_batch, [None] * num_batch
-
-    ade_bigls = []
-    fde_bigls = []
-
-    coll_joint_data_bigls = []
+    # batches go to the evaluator as they come, the metrics are accumulated instead of kept per batch
+    if executor is None:
+        executor = EvalExecutor(workers=0)
+    # context: EvalContext of loader_val, the ground-truth terms are then looked up instead of recomputed
+    stream = executor.stream(ks=args.eval_ks, **(context.col_args if context is not None else {'exact_col': args.exact_col}))
 
 
     time_start = time.time()
@@ -212,7 +218,9 @@ def vald(model, device, loader_val, epoch, metrics, constant_metrics, args):
         V_tr_tmp = torch.cat((V_tr_tmp_start, V_tr_tmp[:,:,1:,:]),dim=2) # [1, 2, 12, num_person]
         
         
-        V_pred, _= model(V_obs_tmp, A_obs_tmp, V_tr_tmp)  # [1, 5, 12, num_person], [1, num_person, 60]
+        with cpu_autocast(args.bf16):
+            V_pred, _= model(V_obs_tmp, A_obs_tmp, V_tr_tmp)  # [1, 5, 12, num_person], [1, num_person, 60]
+        V_pred = V_pred.float()
 
         # V_pred,_ = model(V_obs_tmp, A_obs_temp)
 
@@ -236,45 +244,27 @@ def vald(model, device, loader_val, epoch, metrics, constant_metrics, args):
         num_of_objs = obs_traj_rel.shape[1]
         V_pred, V_tr = V_pred[:, :num_of_objs, :], V_tr[:, :num_of_objs, :]
 
-        # For now I have my bi-variate parameters
-        sx = torch.exp(V_pred[:, :, 2])  # sx
-        sy = torch.exp(V_pred[:, :, 3])  # sy
-        corr = torch.tanh(V_pred[:, :, 4])  # corr
-
-        cov = torch.zeros(V_pred.shape[0], V_pred.shape[1], 2, 2).to(device)
-        cov[:, :, 0, 0] = sx * sx
-        cov[:, :, 0, 1] = corr * sx * sy
-        cov[:, :, 1, 0] = corr * sx * sy
-        cov[:, :, 1, 1] = sy * sy
-        mean = V_pred[:, :, 0:2]
-        # dimensionality reminder: mean: [12, num_person, 2], cov: [12, num_person, 2, 2]
 
         """pytorch solution for sampling"""
         time_sampling_start = time.time()
 
-        mvnormal = torchdist.MultivariateNormal(mean, cov)
-        kstep_V_pred_ls = []
-        KSTEPS=20
-        for i in range(KSTEPS):
-            kstep_V_pred_ls.append(mvnormal.sample().cpu().numpy())  # cat [12, num_person, 2]
-        kstep_V_pred_ls = np.stack(kstep_V_pred_ls, axis=0) # [KSTEPS, 12, num_person, 2]
-
-        kstep_V_pred = np.concatenate([traj for traj in kstep_V_pred_ls], axis=1) # [12, KSTEPS * num_person, 2]
+        KSTEPS=max(args.eval_ks)
+        kstep_V_pred = sample_bivariate(V_pred, KSTEPS) # [KSTEPS, 12, num_person, 2]
 
         time_sampling_elapsed = time.time() - time_sampling_start
         time_sampling += time_sampling_elapsed
         """end of sampling"""
 
-        V_x = seq_to_nodes(obs_traj.data.cpu().numpy()) # [8, num_person, 2]
-        V_y_rel_to_abs = nodes_rel_to_nodes_abs(V_tr.data.cpu().numpy().squeeze(), V_x[-1, :, :]) # [12, num_person, 2] speed???
-
-        kstep_V_x = np.concatenate([V_x[-1, :, :]] * KSTEPS, axis=0)  # cat along number of person
-        kstep_V_pred_rel_to_abs = nodes_rel_to_nodes_abs(kstep_V_pred, kstep_V_x).reshape(12, KSTEPS, num_of_objs, 2)
-        kstep_V_pred_rel_to_abs = kstep_V_pred_rel_to_abs.transpose((1, 0, 2, 3))  # [KSTEPS, 12, num_object, 2]
+        # rel -> abs on device, the tensors only leave it when handed to the evaluator
+        if context is not None:
+            start, V_y_rel_to_abs, mask = context.starts[cnt], context.targets[cnt], context.masks[cnt]
+        else:
+            start = seq_to_nodes_torch(obs_traj)[-1] # [num_person, 2]
+            V_y_rel_to_abs = nodes_rel_to_nodes_abs_torch(V_tr, start) # [12, num_person, 2]
+            mask = A_obs_tmp[1,:,:]!=0 #64*64
+        kstep_V_pred_rel_to_abs = nodes_rel_to_nodes_abs_torch(kstep_V_pred, start) # [KSTEPS, 12, num_object, 2]
 
-        V_pred_rel_to_abs_ksteps_ls[cnt] = kstep_V_pred_rel_to_abs  # np.ndarray
-        V_y_rel_to_abs_ls[cnt] = V_y_rel_to_abs  # np.ndarray
-        mask_ls[cnt] =  A_obs_tmp[1,:,:].cpu().numpy()!=0 #cnt*64*64
+        stream.add(kstep_V_pred_rel_to_abs, V_y_rel_to_abs, mask)
     
     time_elapsed = time.time() - time_start
 
@@ -288,153 +278,24 @@ def vald(model, device, loader_val, epoch, metrics, constant_metrics, args):
     logging.info('VALD: Best Epoch:{:.6f}, Best Loss:{:.6f}'.format(constant_metrics['min_val_epoch'],constant_metrics['min_val_loss']))
 
     time_start = time.time()
-    func_batch_input = []
-    for batch_idx in range(num_batch):
-        V_pred_rel_to_abs_ksteps = V_pred_rel_to_abs_ksteps_ls[batch_idx]
-        V_y_rel_to_abs = V_y_rel_to_abs_ls[batch_idx]
-        mask_pred = mask_ls[batch_idx]
-        if epoch == 0:
-            cur_tuple = (batch_idx, V_pred_rel_to_abs_ksteps, V_y_rel_to_abs, mask_pred, True)
-        else:
-            cur_tuple = (batch_idx, V_pred_rel_to_abs_ksteps, V_y_rel_to_abs, mask_pred, False)
-        func_batch_input.append(cur_tuple)
-    with multiprocessing.Pool(processes=multiprocessing.cpu_count()) as pool:
-        results = pool.starmap(process_batch_data, func_batch_input)
+    summaries = stream.result().summaries()
     time_elapsed = time.time() - time_start
-    logging.info('Time to multiprocess all {:d} pieces of batch data: {:.6f}s'.format(num_batch, time_elapsed))
-
-    for idx_proc, result in enumerate(results):
-
-        ade_bigls += result[0]  # list cat
-        fde_bigls += result[1]  # list cat
-        coll_joint_data_bigls.append(result[3])  # append np.ndarray
-
-    coll_joint_step, coll_joint_cum = coll_data_post_processing(coll_joint_data_bigls)
-
-
-    ade_ = sum(ade_bigls) / len(ade_bigls)
-    fde_ = sum(fde_bigls) / len(fde_bigls)
+    logging.info('Time to finish evaluating {:d} pieces of batch data: {:.6f}s'.format(num_batch, time_elapsed))
     
-    logging.info("VALD: ADE: {:.4f}, FDE: {:.4f}, COL: {:.4f}".format(ade_, fde_, coll_joint_cum[2]))
-
-def coll_data_post_processing(coll_data_bigls):
-    coll_raw_ = np.concatenate(coll_data_bigls, axis=0)  # [X, 56]
-    coll_step_ = np.mean(coll_raw_, axis=0)  # [56]
-    coll_step_ = coll_step_[:-1].reshape(-1, 5).mean(axis=1)  # [11]
-    coll_cumulative_ = np.asarray([np.mean(coll_raw_[:, :i * 5 + 6].max(axis=1)) for i in range(11)])  # int
-    return coll_step_, coll_cumulative_
-
-def stack_dict(data_dict):
-    for key, coll_step_data in zip(data_dict.keys(), data_dict.values()):
-        data_dict[key] = np.stack(coll_step_data, axis=0)  # [X, 56]
-    return data_dict
-
-
-def process_batch_data(batch_idx: int, V_pred_rel_to_abs_ksteps: np.ndarray, V_y_rel_to_abs: np.ndarray, mask_pred: np.ndarray, compute_col_truth=False):
-     # [KSTEPS, 12, num_object, 2]  # [12, num_object, 2]
-    ade_ls = {}
-    fde_ls = {}
-    coll_ls = {}
-    coll_joint_data_ls = {}
-    coll_cross_data_ls = {}
-    coll_truth_data_ls = {}
-
-    num_of_objs = V_y_rel_to_abs.shape[1]
-    for n in range(num_of_objs):
-        ade_ls[n] = []
-        fde_ls[n] = []
-        coll_ls[n] = []
-        coll_joint_data_ls[n] = []
-        coll_cross_data_ls[n] = []
-        coll_truth_data_ls[n] = []
-
-    KSTEPS = len(V_pred_rel_to_abs_ksteps)
-    # print('Detected ksteps: {:d}'.format(KSTEPS))
-    for k in range(KSTEPS):
-        V_pred_rel_to_abs = V_pred_rel_to_abs_ksteps[k]
-
-        for n in range(num_of_objs):
-            pred = [V_pred_rel_to_abs[:, n:n + 1, :]] # 12,1,2
-            target = [V_y_rel_to_abs[:, n:n + 1, :]] # 12,1,2
-            number_of = [1]
-
-            ade_ls[n].append(ade(pred, target, number_of))
-            fde_ls[n].append(fde(pred, target, number_of))
-
-            ######
-            predicted_traj = V_pred_rel_to_abs[:, n, :]  # [12, 2]
-            predicted_trajs_all = V_pred_rel_to_abs.transpose(1, 0, 2)  # [num_person, 12, 2]
-            mask = mask_pred[n,:] # 64
-            col_mask_joint = compute_col_pred(predicted_traj, predicted_trajs_all, mask).astype(np.float64)  # [56], between predictions
-
-            target_traj = V_y_rel_to_abs[:, n, :]  # [12, 2]
-            target_trajs_all = V_y_rel_to_abs.transpose(1, 0, 2)  # [num_person, 12, 2]
-            col_mask_cross = compute_col_pred(predicted_traj, target_trajs_all, mask).astype(np.float64)  # [56], prediction x ground-truth
-
-            if compute_col_truth: # fist epoch
-                col_mask_truth = compute_col_pred(target_traj, target_trajs_all, mask).astype(np.float64)  # [56], between ground-truth
-                coll_truth_data_ls[n].append(col_mask_truth)
-
-            if col_mask_joint.sum():
-                coll_ls[n].append(1)
-            else:
-                coll_ls[n].append(0)
-            coll_joint_data_ls[n].append(col_mask_joint) # object*20*56
-            coll_cross_data_ls[n].append(col_mask_cross)
-            ######
-
-    coll_joint_data_ls = stack_dict(coll_joint_data_ls)  # object*20*56
-    coll_cross_data_ls = stack_dict(coll_cross_data_ls)
-    if compute_col_truth:
-        coll_truth_data_ls = stack_dict(coll_truth_data_ls)
-    #  internal processing ends
-
-    #  write data to the returned list, appending is okay as the order is not important
-    ade_bigls_item, fde_bigls_item, coll_bigls_item = [], [], []
-    for n in range(num_of_objs):
-        ade_bigls_item.append(min(ade_ls[n]))  # float
-        fde_bigls_item.append(min(fde_ls[n]))  # float
-        coll_bigls_item.append(sum(coll_ls[n]) / len(coll_ls[n]))  # float
-    coll_joint_data_bigls_item = np.concatenate([ls for ls in coll_joint_data_ls.values()], axis=0)  # [object*20, 56], np.ndarray
-    coll_cross_data_bigls_item = np.concatenate([ls for ls in coll_cross_data_ls.values()], axis=0)
-    if compute_col_truth:
-        coll_truth_data_bigls_item = np.concatenate([ls for ls in coll_truth_data_ls.values()], axis=0)
-    else:
-        coll_truth_data_bigls_item = None
-
-    return ade_bigls_item, fde_bigls_item, coll_bigls_item, coll_joint_data_bigls_item, coll_cross_data_bigls_item, coll_truth_data_bigls_item
+    for K, (ade_, fde_, _, coll_joint_step, coll_joint_cum) in ((K, summary[:5]) for K, summary in summaries.items()):
+        logging.info("VALD: Best-of-{:d}: ADE: {:.4f}, FDE: {:.4f}, COL: {:.4f}".format(K, ade_, fde_, coll_joint_cum[2]))
 
-
-def sample_pred(V_pred, V_tr, i):
+def sample_pred(V_pred, V_tr, i, KSTEPS=20):
     # V_tr [1,12,64,2]
     device= V_pred.device
     V_pred = V_pred.permute(0, 2, 3, 1) #  [1, 12, num_person, 5]]
     V_pred = V_pred[:,-1:,:,:]
     V_pred = V_pred.squeeze(0) #  [-1, num_person, 5]
-    # For now I have my bi-variate parameters
-    sx = torch.exp(V_pred[:, :, 2])  # sx
-    sy = torch.exp(V_pred[:, :, 3])  # sy
-    corr = torch.tanh(V_pred[:, :, 4])  # corr
-
-    cov = torch.zeros(V_pred.shape[0], V_pred.shape[1], 2, 2).to(device)
-    cov[:, :, 0, 0] = sx * sx
-    cov[:, :, 0, 1] = corr * sx * sy
-    cov[:, :, 1, 0] = corr * sx * sy
-    cov[:, :, 1, 1] = sy * sy
-    mean = V_pred[:, :, 0:2]
-
-    mvnormal = torchdist.MultivariateNormal(mean, cov)
-
-
-    # V_pred_result = mvnormal.sample().reshape(1,-1,2)
-    kstep_V_pred_ls = []
-    for j in range(20):
-        kstep_V_pred_ls.append(mvnormal.sample())  # cat [-1, num_person, 2]
-    kstep_V_pred = torch.cat(kstep_V_pred_ls,dim=0) #[-1*20, num_person, 2]
+    kstep_V_pred = sample_bivariate(V_pred, KSTEPS).reshape(-1, V_pred.shape[1], 2) #[-1*KSTEPS, num_person, 2]
     
     V_this = V_tr.squeeze()[i:i+1,:,:] #[-1, num_person, 2]
 
-    distance = F.pairwise_distance(kstep_V_pred.reshape(-1,2), V_this.repeat(20,1,1).reshape(-1,2), p=2).reshape(-1,kstep_V_pred.size()[1])
+    distance = F.pairwise_distance(kstep_V_pred.reshape(-1,2), V_this.repeat(KSTEPS,1,1).reshape(-1,2), p=2).reshape(-1,kstep_V_pred.size()[1])
     index=torch.argmin(distance,dim=0)
     index=index.reshape(1,kstep_V_pred.size()[1],1).repeat(1,1,2)
     V_pred_result=torch.gather(kstep_V_pred, 0, index) #[-1, num_person, 2]
@@ -442,20 +303,24 @@ def sample_pred(V_pred, V_tr, i):
     return V_pred_result
 
 
-def test(model, device, loader_test, epoch, KSTEPS=20):
+def test(model, device, loader_test, epoch, KSTEPS=20, rollout=False, bf16=False, executor=None, wait=True, context=None, ks=None,
+         exact_col=False):
+    # with wait=False the metrics are left running on executor, returns (EvalStream, raw_data_dict), stream.result().summary() later
+    # context: EvalContext of loader_test, the ground-truth terms and collision curves are then reused
+    # ks: best-of-K values to report, max(ks) samples are drawn once and the smaller K use their prefixes
+    if ks is not None:
+        KSTEPS = max(ks)
     model.eval()
     loss_batch = 0
     batch_count = 0
-    # save batch data to list for later multi-processing
+    # batches are streamed to the evaluation workers and folded into running metrics
     num_batch = len(loader_test)
-    V_pred_rel_to_abs_ksteps_ls, V_y_rel_to_abs_ls, mask_ls = [None] * num_batch, [None] * num_batch, [None] * num_batch
-
-    ade_bigls = []
-    fde_bigls = []
-    coll_bigls = []
-    coll_joint_data_bigls = []
-    coll_cross_data_bigls = []
-    coll_truth_data_bigls = []
+    if executor is None:
+        executor = EvalExecutor(workers=0)
+    # the truth curves of the context were computed with its collision settings, the predictions use the same
+    col_args = context.col_args if context is not None else {'exact_col': exact_col}
+    stream = executor.stream(compute_col_truth=epoch == 0, truth=context.truth if context is not None else None, ks=ks,
+                             **col_args)
     raw_data_dict = {}
 
     time_start = time.time()
@@ -483,11 +348,29 @@ def test(model, device, loader_test, epoch, KSTEPS=20):
         V_tr_tmp = V_tr_tmp_start # [1, 2, 1, num_person]
 
 
-        for i in range(V_tr.shape[1]):
-            V_pred , _  = model(V_obs_tmp, A_obs_tmp, V_tr_tmp) #  [1, 5, 1, num_person]
-            output=  sample_pred(V_pred, V_tr, i) #  [-1, num_person, 2]
-            output = output.permute(2,0,1).unsqueeze(0)
-            V_tr_tmp = torch.cat((V_tr_tmp, output), 2)
+        if rollout:
+            # KSTEPS independent sampled rollouts decoded as one batch
+            with cpu_autocast(bf16):
+                kstep_V_pred_rollout, V_pred = model.rollout(V_obs_tmp, A_obs_tmp, V_tr.shape[1], KSTEPS) # [KSTEPS, 12, num_person, 2]
+            V_pred = V_pred[:1].float() # [1, 5, 12, num_person]
+        else:
+            # the graph and encoder stack only see the observed history, run them once per scene
+            with cpu_autocast(bf16):
+                memory, src_att, _ = model.encode(V_obs_tmp, A_obs_tmp)
+
+            if model.one_shot:
+                # whole horizon from the learned queries in a single decoder pass
+                with cpu_autocast(bf16):
+                    V_pred = model.decode_one_shot(memory, src_att, V_obs_tmp.shape[3]) #  [1, 5, 12, num_person]
+                V_pred = V_pred.float()
+            else:
+                for i in range(V_tr.shape[1]):
+                    with cpu_autocast(bf16):
+                        V_pred = model.decode_step(memory, src_att, V_tr_tmp) #  [1, 5, 1, num_person]
+                    V_pred = V_pred.float()
+                    output=  sample_pred(V_pred, V_tr, i) #  [-1, num_person, 2]
+                    output = output.permute(2,0,1).unsqueeze(0)
+                    V_tr_tmp = torch.cat((V_tr_tmp, output), 2)
 
         # V_pred,_ = model(V_obs_tmp, A_obs_temp)
 
@@ -506,44 +389,29 @@ def test(model, device, loader_test, epoch, KSTEPS=20):
         num_of_objs = obs_traj_rel.shape[1]
         V_pred, V_tr = V_pred[:, :num_of_objs, :], V_tr[:, :num_of_objs, :]
 
-        # For now I have my bi-variate parameters
-        sx = torch.exp(V_pred[:, :, 2])  # sx
-        sy = torch.exp(V_pred[:, :, 3])  # sy
-        corr = torch.tanh(V_pred[:, :, 4])  # corr
-
-        cov = torch.zeros(V_pred.shape[0], V_pred.shape[1], 2, 2).to(device)
-        cov[:, :, 0, 0] = sx * sx
-        cov[:, :, 0, 1] = corr * sx * sy
-        cov[:, :, 1, 0] = corr * sx * sy
-        cov[:, :, 1, 1] = sy * sy
-        mean = V_pred[:, :, 0:2]
-        # dimensionality reminder: mean: [12, num_person, 2], cov: [12, num_person, 2, 2]
 
         """pytorch solution for sampling"""
         time_sampling_start = time.time()
 
-        mvnormal = torchdist.MultivariateNormal(mean, cov)
-        kstep_V_pred_ls = []
-        for i in range(KSTEPS):
-            kstep_V_pred_ls.append(mvnormal.sample().cpu().numpy())  # cat [12, num_person, 2]
-        kstep_V_pred_ls = np.stack(kstep_V_pred_ls, axis=0) # [KSTEPS, 12, num_person, 2]
-
-        kstep_V_pred = np.concatenate([traj for traj in kstep_V_pred_ls], axis=1) # [12, KSTEPS * num_person, 2]
+        if rollout:
+            kstep_V_pred = kstep_V_pred_rollout[:, :, :num_of_objs, :] # [KSTEPS, 12, num_person, 2]
+        else:
+            kstep_V_pred = sample_bivariate(V_pred, KSTEPS) # [KSTEPS, 12, num_person, 2]
 
         time_sampling_elapsed = time.time() - time_sampling_start
         time_sampling += time_sampling_elapsed
         """end of sampling"""
 
-        V_x = seq_to_nodes(obs_traj.data.cpu().numpy()) # [8, num_person, 2]
-        V_y_rel_to_abs = nodes_rel_to_nodes_abs(V_tr.data.cpu().numpy().squeeze(), V_x[-1, :, :]) # [12, num_person, 2] speed???
-
-        kstep_V_x = np.concatenate([V_x[-1, :, :]] * KSTEPS, axis=0)  # cat along number of person
-        kstep_V_pred_rel_to_abs = nodes_rel_to_nodes_abs(kstep_V_pred, kstep_V_x).reshape(12, KSTEPS, num_of_objs, 2)
-        kstep_V_pred_rel_to_abs = kstep_V_pred_rel_to_abs.transpose((1, 0, 2, 3))  # [KSTEPS, 12, num_object, 2]
+        # rel -> abs on device, the tensors only leave it when handed to the evaluator
+        if context is not None:
+            start, V_y_rel_to_abs, mask = context.starts[step], context.targets[step], context.masks[step]
+        else:
+            start = seq_to_nodes_torch(obs_traj)[-1] # [num_person, 2]
+            V_y_rel_to_abs = nodes_rel_to_nodes_abs_torch(V_tr, start) # [12, num_person, 2]
+            mask = A_obs_tmp[1,:,:]!=0 #64*64
+        kstep_V_pred_rel_to_abs = nodes_rel_to_nodes_abs_torch(kstep_V_pred, start) # [KSTEPS, 12, num_object, 2]
 
-        V_pred_rel_to_abs_ksteps_ls[step] = kstep_V_pred_rel_to_abs  # np.ndarray
-        V_y_rel_to_abs_ls[step] = V_y_rel_to_abs  # np.ndarray
-        mask_ls[step] =  A_obs_tmp[1,:,:].cpu().numpy()!=0 #cnt*64*64
+        stream.add(kstep_V_pred_rel_to_abs, V_y_rel_to_abs, mask)
     
     time_elapsed = time.time() - time_start
     # log error
@@ -551,43 +419,17 @@ def test(model, device, loader_test, epoch, KSTEPS=20):
     logging.info('Time to prepare all {:d} pieces of batch data: {:.6f}s'.format(num_batch, time_elapsed))
     logging.info('In particular, time for multivariate gaussian distribution sampling: {:.6f}s'.format(time_sampling))
 
+    # submit the last partial chunk
+    stream.flush()
+    if not wait:
+        return stream, raw_data_dict
+
     time_start = time.time()
-    func_batch_input = []
-    for batch_idx in range(num_batch):
-        V_pred_rel_to_abs_ksteps = V_pred_rel_to_abs_ksteps_ls[batch_idx]
-        V_y_rel_to_abs = V_y_rel_to_abs_ls[batch_idx]
-        mask_pred = mask_ls[batch_idx]
-        if epoch == 0:
-            cur_tuple = (batch_idx, V_pred_rel_to_abs_ksteps, V_y_rel_to_abs, mask_pred, True)
-        else:
-            cur_tuple = (batch_idx, V_pred_rel_to_abs_ksteps, V_y_rel_to_abs, mask_pred, False)
-        func_batch_input.append(cur_tuple)
-    with multiprocessing.Pool(processes=multiprocessing.cpu_count()) as pool:
-        results = pool.starmap(process_batch_data, func_batch_input)
+    summary = stream.result().summary()
     time_elapsed = time.time() - time_start
-    logging.info('Time to multiprocess all {:d} pieces of batch data: {:.6f}s'.format(num_batch, time_elapsed))
-
-    for idx_proc, result in enumerate(results):
-        ade_bigls += result[0]  # list cat
-        fde_bigls += result[1]  # list cat
-        coll_bigls += result[2]  # list cat
-        coll_joint_data_bigls.append(result[3])  # append np.ndarray
-        coll_cross_data_bigls.append(result[4])
-        if epoch == 0:
-            coll_truth_data_bigls.append(result[5])  # could be None
-
-    coll_joint_step, coll_joint_cum = coll_data_post_processing(coll_joint_data_bigls)
-    coll_cross_step, coll_cross_cum = coll_data_post_processing(coll_cross_data_bigls)
-    if epoch == 0:
-        coll_truth_step, coll_truth_cum = coll_data_post_processing(coll_truth_data_bigls)
-    else:
-        coll_truth_step, coll_truth_cum = None, None
-
-    ade_ = sum(ade_bigls) / len(ade_bigls)
-    fde_ = sum(fde_bigls) / len(fde_bigls)
-    coll_ = sum(coll_bigls) / len(coll_bigls)
+    logging.info('Time to finish evaluating {:d} pieces of batch data: {:.6f}s'.format(num_batch, time_elapsed))
 
-    return ade_, fde_, coll_, coll_joint_step, coll_joint_cum, coll_cross_step, coll_cross_cum, coll_truth_step, coll_truth_cum, raw_data_dict
+    return summary + (raw_data_dict,)
 
 def config_parser():
     parser = argparse.ArgumentParser()
@@ -636,6 +478,28 @@ def config_parser():
     parser.add_argument('--contrast_minsep', type=float, default=0.2)
     parser.add_argument('--safe_traj', action='store_true', default=False,
                         help='remove training trajectories with collision')
+    parser.add_argument('--rollout', action='store_true', default=False,
+                        help='evaluate KSTEPS sampled autoregressive rollouts instead of one decoded trajectory')
+    parser.add_argument('--quantize', action='store_true', default=False,
+                        help='after training, compare the best model with its dynamic INT8 copy on CPU')
+    parser.add_argument('--bf16', action='store_true', default=False,
+                        help='run the model under CPU bf16 autocast, the loss and sampling stay in FP32')
+    parser.add_argument('--checkpoint_layers', type=int, default=0,
+                        help='recompute the activations of this many encoder and decoder layers in backward')
+    parser.add_argument('--checkpoint_gcns', type=int, default=0,
+                        help='recompute the activations of this many st_gcn blocks in backward')
+    parser.add_argument('--eval_workers', type=int, default=default_workers(),
+                        help='processes of the evaluation pool kept for the whole run, 0 evaluates in the main process. '
+                             'Each worker is a spawned interpreter that imports torch (a few hundred MB of RAM), '
+                             'defaults to min(cpu_count, 4)')
+    parser.add_argument('--eval_ks', type=int, nargs='+', default=[20],
+                        help='best-of-K values reported by vald/test from one set of max(K) samples, e.g. 1 5 10 20')
+    parser.add_argument('--exact_col', action='store_true', default=False,
+                        help='swept-segment collision check instead of the interpolated points, changes the reported COL')
+    parser.add_argument('--eval_cache', action='store_true', default=False,
+                        help='keep the ground-truth side of the val/test evaluation on disk next to the dataset cache')
+    parser.add_argument('--one_shot', action='store_true', default=False,
+                        help='decode the whole horizon in one pass from learned queries instead of autoregressively')
 
     # ------------------transformer setting-------------------------------
 
@@ -646,6 +510,10 @@ def config_parser():
     parser.add_argument('--factor', type=float, default=1.)
     parser.add_argument('--warmup', type=int, default=10)
     parser.add_argument('--fw',type=int, default=128)
+    parser.add_argument('--attn_backend', type=str, default='reference',
+                        help='reference, sdpa, chunked or auto')
+    parser.add_argument('--fused_norm', action='store_true', default=False,
+                        help='use torch layer_norm for the transformer LayerNorms')
 
 
     args = parser.parse_args()
@@ -688,7 +556,9 @@ def config_model(args, device, checkpoint_dir):
                           output_feat=args.output_size, seq_len=args.obs_seq_len,
                           kernel_size=args.kernel_size, pred_seq_len=args.pred_seq_len,
                           emb_size=args.emb_size, fw=args.fw, heads=args.heads,layers=args.layers,dropout=args.dropout,
-                          checkpoint_dir=checkpoint_dir).to(device)
+                          checkpoint_dir=checkpoint_dir, attn_backend=args.attn_backend,
+                          fused_norm=args.fused_norm, checkpoint_layers=args.checkpoint_layers,
+                          checkpoint_gcns=args.checkpoint_gcns, one_shot=args.one_shot).to(device)
 
     projection_head = ProjHead(feat_dim=args.pred_seq_len*5 + (args.obs_seq_len)*2, hidden_dim=32, head_dim=8).to(device) # 60+16 
     if args.contrast_sampling == 'event':
@@ -844,6 +714,8 @@ def main():
     logging.info('*' * 30)
     logging.info("Training initiating....")
     logging.info(args)
+    if args.quantize and args.bf16:
+        logging.warning('--bf16 only applies to training and evaluation, the INT8 vs FP32 comparison of --quantize runs in FP32')
 
     # Define the model
     # lanni:Contrastive learning module # trainable parameters: 2976
@@ -852,6 +724,16 @@ def main():
     # Data loader
     loader_train, loader_val, loader_test = get_dataloader(args.batch_size, args.dataset, args.obs_seq_len, args.pred_seq_len, checkpoint_dir)
 
+    # ground-truth terms of the val/test metrics, built once instead of every epoch
+    def eval_cache_path(loader):
+        if not args.eval_cache:
+            return None
+        return os.path.join(loader.dataset.data_dir, 'eval_context_{:d}_{:d}{:s}.pt'.format(
+            args.obs_seq_len, args.pred_seq_len, '_exact' if args.exact_col else ''))
+    # targets and masks only go to shared memory when there are workers to read them
+    context_val = EvalContext(loader_val, device, eval_cache_path(loader_val), args.exact_col, share=args.eval_workers > 0)
+    context_test = EvalContext(loader_test, device, eval_cache_path(loader_test), args.exact_col, share=args.eval_workers > 0)
+
     # Optimizer settings
     # optimizer = torch.optim.Adam(model.parameters(), lr=args.lr)
     # transformer optimizer
@@ -881,36 +763,23 @@ def main():
 
     df = pandas.DataFrame(columns=['Epoch', 'total_loss', 'task_loss', 'contrast_loss', 'validation_loss', 'ADE', 'FDE', 'COLL'])
     
-    for epoch in range(args.num_epochs):
-        time_start = time.time()
-        train(model, contrastive, optimizer, device, loader_train, epoch, metrics, args)
-        time_elapsed = time.time() - time_start
-        logging.info('Time to train once: {:.2f} s for dataset {:s}'.format(time_elapsed, args.dataset))
+    # metrics of epoch e are computed by the workers while epoch e+1 trains, the bookkeeping below runs once they are in
+    executor = EvalExecutor(workers=args.eval_workers)
+    pending_test = None
 
+    def finish_test(epoch, pending, epoch_metrics, epoch_constant_metrics, epoch_state_dict):
+        nonlocal df, best_ade, best_fde, best_coll, best_ttl_error, best_coll_joint_c4
         time_start = time.time()
-        vald(model, device, loader_val, epoch, metrics, constant_metrics, args)
+        accumulator = pending.result()
+        ad, fd, coll, coll_joint_step, coll_joint_cum, coll_cross_step, coll_cross_cum, coll_truth_step, coll_truth_cum = \
+            accumulator.summary()
         time_elapsed = time.time() - time_start
-        logging.info('Time to validate once: {:.2f} s for dataset {:s}'.format(time_elapsed, args.dataset))
-        if args.use_lrschd:
-            ttl_loss = metrics['train_loss'][-1]
-            scheduler.step(ttl_loss)  # learning rate decay once training stagnates
+        logging.info('Epoch {:d} test metrics ready, waited {:.2f} s'.format(epoch, time_elapsed))
+        for K, summary_K in accumulator.summaries().items():
+            logging.info("Best-of-{:d}: ADE: {:.4f}, FDE: {:.4f}, COL: {:.4f}".format(K, summary_K[0], summary_K[1], summary_K[4][2]))
 
-        logging.info('###########################################')
-        logging.info('Epoch:{:s} : {:d}'.format(args.tag,epoch))
-        for k, v in metrics.items():
-            if len(v) > 0:
-                logging.info('{:s}: {:.6f}'.format(k, v[-1]))
-
-        """Test per epoch"""
-        ade_, fde_, coll_ = 999999.0, 999999.0, 999999.0
-        logging.info("Testing ....")
-        time_start = time.time()
-        ad, fd, coll, coll_joint_step, coll_joint_cum, coll_cross_step, coll_cross_cum, coll_truth_step, coll_truth_cum, _ = test(
-            model, device, loader_test, epoch)        
-        
         # lanni: coll_joint_cum
-        time_elapsed = time.time() - time_start
-        logging.info('Time to test once: {:.2f} s for dataset {:s}'.format(time_elapsed, args.dataset))
+        ade_, fde_, coll_ = 999999.0, 999999.0, 999999.0
         ade_, fde_, coll_ = min(ade_, ad), min(fde_, fd), min(coll_, coll_joint_cum[2])
         ttl_error_ = np.clip(ade_ - target_ade, a_min=0.0, a_max=None) + np.clip(fde_ - target_fde, a_min=0.0, a_max=None) + coll_
 
@@ -930,8 +799,8 @@ def main():
             "Best ADE: {:.4f}, Best FDE: {:.4f}, Best COL: {:.4f}, Best Total ERROR: {:.4f}, Best COL_JOINT_C4: {:.4F}".format(
                 best_ade, best_fde, best_coll, best_ttl_error, best_coll_joint_c4))
 
-        df.loc[len(df)] = [epoch, metrics['train_loss'][-1], metrics['task_loss'][-1], metrics['contrast_loss'][-1],
-                           metrics['val_loss'][-1], ade_, fde_, coll_]
+        df.loc[len(df)] = [epoch, epoch_metrics['train_loss'][-1], epoch_metrics['task_loss'][-1], epoch_metrics['contrast_loss'][-1],
+                           epoch_metrics['val_loss'][-1], ade_, fde_, coll_]
         df = df.sort_values(by=['Epoch'])
         if not os.path.exists(csv_path):
             df.iloc[-1:].to_csv(csv_path, mode='a', index=False)
@@ -942,21 +811,71 @@ def main():
         logging.info('Best epoch up to now is {}'.format(best_epoch))
         """Test ends"""
 
-        logging.info(constant_metrics)
+        logging.info(epoch_constant_metrics)
         logging.info('*'*30)
 
         with open(history_dir+'epoch{:03d}_metrics.pkl'.format(epoch), 'wb') as fp:
-            pickle.dump(metrics, fp)
+            pickle.dump(epoch_metrics, fp)
 
         with open(history_dir+'epoch{:03d}_constant_metrics.pkl'.format(epoch), 'wb') as fp:
-            pickle.dump(constant_metrics, fp)
+            pickle.dump(epoch_constant_metrics, fp)
 
-        torch.save(model.state_dict(), history_dir + 'epoch{:03d}_val_best.pth'.format(epoch))
+        # weights as they were when the epoch was tested, the live model has moved on by now
+        torch.save(epoch_state_dict, history_dir + 'epoch{:03d}_val_best.pth'.format(epoch))
 
         # model selection
         shutil.copy(history_dir+'epoch{:03d}_metrics.pkl'.format(best_epoch), checkpoint_dir + 'metrics.pkl')
         shutil.copy(history_dir+'epoch{:03d}_constant_metrics.pkl'.format(best_epoch), checkpoint_dir + 'constant_metrics.pkl')
         shutil.copy(history_dir+'epoch{:03d}_val_best.pth'.format(best_epoch), checkpoint_dir + 'val_best.pth')
+
+    for epoch in range(args.num_epochs):
+        time_start = time.time()
+        train(model, contrastive, optimizer, device, loader_train, epoch, metrics, args)
+        time_elapsed = time.time() - time_start
+        logging.info('Time to train once: {:.2f} s for dataset {:s}'.format(time_elapsed, args.dataset))
+
+        time_start = time.time()
+        vald(model, device, loader_val, epoch, metrics, constant_metrics, args, executor, context_val)
+        time_elapsed = time.time() - time_start
+        logging.info('Time to validate once: {:.2f} s for dataset {:s}'.format(time_elapsed, args.dataset))
+        if args.use_lrschd:
+            ttl_loss = metrics['train_loss'][-1]
+            scheduler.step(ttl_loss)  # learning rate decay once training stagnates
+
+        logging.info('###########################################')
+        logging.info('Epoch:{:s} : {:d}'.format(args.tag,epoch))
+        for k, v in metrics.items():
+            if len(v) > 0:
+                logging.info('{:s}: {:.6f}'.format(k, v[-1]))
+
+        """Test per epoch"""
+        logging.info("Testing ....")
+        time_start = time.time()
+        pending, _ = test(model, device, loader_test, epoch, rollout=args.rollout, bf16=args.bf16, executor=executor, wait=False,
+                          context=context_test, ks=args.eval_ks, exact_col=args.exact_col)
+        time_elapsed = time.time() - time_start
+        logging.info('Time to test once: {:.2f} s for dataset {:s}'.format(time_elapsed, args.dataset))
+
+        if pending_test is not None:
+            finish_test(*pending_test)
+        pending_test = (epoch, pending, copy.deepcopy(metrics), copy.deepcopy(constant_metrics),
+                        {k: v.detach().cpu().clone() for k, v in model.state_dict().items()})
+
+    if pending_test is not None:
+        finish_test(*pending_test)
+    executor.shutdown()
+
+    if args.quantize:
+        logging.info('Comparing INT8 and FP32 on the test set ....')
+        model.load_state_dict(torch.load(checkpoint_dir + 'val_best.pth', map_location=device))
+
+        def evaluate(cur_model):
+            # quantized::linear_dynamic only takes FP32 inputs, both sides of the comparison run without autocast
+            summary = test(cur_model, torch.device('cpu'), loader_test, 1, rollout=args.rollout, bf16=False,
+                           ks=args.eval_ks, exact_col=args.exact_col)[:-1] # drop raw_data_dict
+            ad, fd, _, _, coll_joint_cum = summary[:5]
+            return ad, fd, coll_joint_cum[2]
+        logging.info(format_comparison(compare_quantized(evaluate, model)))
         
 
 if __name__ == '__main__':
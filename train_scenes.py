@@ -0,0 +1,179 @@
+import os
+import pickle
+import argparse
+import shutil
+import time
+import torch
+
+from utils import collate_scenes, cpu_autocast
+from metrics import bivariate_loss
+from model_b import SGTN
+from train import set_seed, set_cuda, get_output_dir, setup_logging, get_dataloader
+
+from transformer.noam_opt import NoamOpt
+
+# model_b.SGTN trained on batches of scenes: utils.collate_scenes pads every batch to its largest scene and
+# the agent mask keeps the padded agents out of the st_gcn BatchNorm statistics and of the loss, instead of
+# packing the scenes into one block-diagonal adjacency
+
+def parse_args():
+    parser = argparse.ArgumentParser()
+
+    parser.add_argument('--folder_date',type=str, default='0909')
+    parser.add_argument('--dataset',type=str, default='zara1test')
+    parser.add_argument('--exp',type=str, default='scenes')
+
+    parser.add_argument('--gpu_deterministic', type=bool, default=False)
+    parser.add_argument('--seed', type=int, default=113)
+
+    parser.add_argument('--input_size', type=int, default=2)
+    parser.add_argument('--output_size', type=int, default=5)
+    parser.add_argument('--obs_seq_len', type=int, default=8)
+    parser.add_argument('--pred_seq_len', type=int, default=12)
+    parser.add_argument('--skip', type=int, default=1)
+    parser.add_argument('--delim',type=str, default='tab')
+    parser.add_argument('--k', type=int, default=64)
+    parser.add_argument('--data_use',type=str, default='graph_data_64.dat')
+
+    parser.add_argument('--scene_batch', type=int, default=16,
+                        help='scenes per batch, padded to the largest one')
+    parser.add_argument('--num_epochs', type=int, default=100)
+    parser.add_argument('--clip_grad', type=float, default=None)
+    parser.add_argument('--bf16', action='store_true', default=False,
+                        help='run the model under CPU bf16 autocast, the loss stays in FP32')
+
+    parser.add_argument('--modelType',type=int, default=1)
+    parser.add_argument('--attnNei',type=int, default=0) # 0: A as is, 2: AdaptiveAdjacency; 1 only works for 64 agents
+
+    parser.add_argument('--num_sstgcn', type=int, default=1)
+    parser.add_argument('--kernel_size', type=int, default=3)
+
+    parser.add_argument('--emb_size',type=int,default=8)
+    parser.add_argument('--heads',type=int, default=4)
+    parser.add_argument('--layers',type=int,default=6)
+    parser.add_argument('--dropout',type=float,default=0.1)
+    parser.add_argument('--factor', type=float, default=1.0)
+    parser.add_argument('--warmup', type=int, default=10)
+    parser.add_argument('--fw',type=int, default=32)
+
+    args = parser.parse_args()
+    if args.attnNei == 1:
+        parser.error('--attnNei 1 re-weights exactly 64 agents, it does not work on padded scenes')
+    return args
+
+
+def scene_loss(model, device, batch, bf16=False):
+    # one collate_scenes batch -> bivariate loss over the real agents
+    batch = [tensor.to(device) for tensor in batch]
+    agent_mask = batch[-1] # [bs, num_person]
+    V_obs, A_obs, V_tr = batch[6].float(), batch[7].float(), batch[8].float()
+    # [bs,8,num_person,2] [bs,8,num_person,num_person] [bs,12,num_person,2]
+
+    V_obs_tmp = V_obs.permute(0, 3, 1, 2)  # [bs, 2, 8, num_person]
+    V_tr_tmp = V_tr.permute(0, 3, 1, 2)  # [bs, 2, 12, num_person]
+    V_tr_tmp = torch.cat((V_obs_tmp[:,:,-1:,:], V_tr_tmp[:,:,:-1,:]),dim=2) # [bs, 2, 12, num_person]
+
+    with cpu_autocast(bf16):
+        V_pred = model(V_obs_tmp, A_obs, V_tr_tmp, -1, 0, None, agent_mask)  # [bs, 5, 12, num_person]
+    V_pred = V_pred.float().permute(0, 2, 3, 1)  # [bs, 12, num_person, 5]
+
+    return bivariate_loss(V_pred, V_tr, agent_mask[:, None, :])
+
+
+def train(model, optimizer, device, loader_train, args):
+    model.train()
+    loss_total_batch = 0
+    batch_count = 0
+
+    for batch in loader_train:
+        batch_count += 1
+        optimizer.optimizer.zero_grad()
+
+        loss_total = scene_loss(model, device, batch, args.bf16)
+        loss_total.backward()
+
+        if args.clip_grad is not None:
+            torch.nn.utils.clip_grad_norm_(model.parameters(),args.clip_grad)
+
+        optimizer.step()
+        loss_total_batch += loss_total.item()
+
+    return loss_total_batch/batch_count
+
+
+def val(model, device, loader, args):
+    model.eval()
+    loss_batch = 0
+    batch_count = 0
+
+    with torch.no_grad():
+        for batch in loader:
+            batch_count += 1
+            loss_batch += scene_loss(model, device, batch, args.bf16).item()
+
+    return loss_batch/batch_count
+
+
+def main():
+
+    args = parse_args()
+
+    output_dir = get_output_dir(args.folder_date, args.dataset, args.exp)
+
+    set_seed(args.seed)
+    set_cuda(deterministic=args.gpu_deterministic)
+    device = torch.device('cuda') if torch.cuda.is_available() else torch.device('cpu')
+
+    logger = setup_logging('job{}'.format(0), output_dir, console=True)
+    logger.info(args)
+    logger.info("Training initiating....")
+
+    # Define the model
+    model = SGTN(n_sstgcn=args.num_sstgcn, input_feat=args.input_size, output_feat=args.output_size,
+                 seq_len=args.obs_seq_len, pred_seq_len=args.pred_seq_len, kernel_size=args.kernel_size,
+                 emb_size=args.emb_size, fw=args.fw, heads=args.heads, layers=args.layers, dropout=args.dropout,
+                 modelnum=args.modelType, attnaj=args.attnNei).to(device)
+
+    # Data loader
+    loader_train, loader_val, loader_test = get_dataloader(args, logger, args.scene_batch, collate_scenes)
+
+    # Optimizer settings
+    optimizer = NoamOpt(args.emb_size, args.factor, len(loader_train)*args.warmup,
+                    torch.optim.Adam(model.parameters(), lr=0, betas=(0.9, 0.98), eps=1e-9))
+
+    # save argument once and for all
+    with open(os.path.join(output_dir, 'args.pkl'), 'wb') as fp:
+        pickle.dump(args, fp)
+
+    logger.info('Checkpoint dir:{:s}' .format(output_dir))
+
+    best_loss = float('inf')
+    best_epoch = 0
+
+    for epoch in range(args.num_epochs):
+
+        logger.info('Training ...')
+        time_start = time.time()
+        train_loss = train(model, optimizer, device, loader_train, args)
+        time_elapsed = time.time() - time_start
+        logger.info('TRAIN: Epoch:{:d}, train loss:{:.4f}'.format(epoch, train_loss))
+        logger.info('Time to train once: {:.4f} s for dataset {:s}'.format(time_elapsed, args.dataset))
+
+        val_loss = val(model, device, loader_val, args)
+        logger.info('VALD: Epoch:{:d}, val loss:{:.4f}'.format(epoch, val_loss))
+        if val_loss < best_loss:
+            best_epoch = epoch
+            best_loss = val_loss
+        logger.info('Best epoch up to now is {}'.format(best_epoch))
+        logger.info('*'*30)
+
+        torch.save(model.state_dict(), os.path.join(output_dir, 'epoch{:03d}_val_best.pth'.format(epoch)))
+        shutil.copy(os.path.join(output_dir, 'epoch{:03d}_val_best.pth'.format(best_epoch)),
+                    os.path.join(output_dir, 'val_best.pth'))
+
+    model.load_state_dict(torch.load(os.path.join(output_dir, 'val_best.pth'), map_location=device))
+    test_loss = val(model, device, loader_test, args)
+    logger.info('TEST: Epoch:{:d}, test loss:{:.4f}'.format(best_epoch, test_loss))
+
+if __name__ == '__main__':
+    main()
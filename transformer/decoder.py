@@ -1,9 +1,10 @@
 # -*- coding: utf-8 -*-
 # date: 2018-11-29 20:07
+import torch
 import torch.nn as nn
 
 from .layer_norm import LayerNorm
-from .functional import clones
+from .functional import clones, checkpoint_block
 
 
 class Decoder(nn.Module):
@@ -15,8 +16,22 @@ class Decoder(nn.Module):
         super(Decoder, self).__init__()
         self.layers = clones(layer, n)
         self.norm = LayerNorm(layer.size)
+        self.checkpoint_layers = 0
+
+    def set_checkpoint_layers(self, n):
+        """
+        Recompute the activations of the first n layers in backward instead of keeping them.
+        """
+        self.checkpoint_layers = n
+        for i, layer in enumerate(self.layers):
+            for m in layer.modules():
+                if hasattr(m, 'keep_attn'):
+                    m.keep_attn = i >= n
 
     def forward(self, x, memory, src_mask, tgt_mask):
-        for layer in self.layers:
-            x = layer(x, memory, src_mask, tgt_mask)
+        for i, layer in enumerate(self.layers):
+            if i < self.checkpoint_layers and self.training and torch.is_grad_enabled():
+                x = checkpoint_block(layer, x, memory, src_mask, tgt_mask)
+            else:
+                x = layer(x, memory, src_mask, tgt_mask)
         return self.norm(x)
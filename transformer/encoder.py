@@ -1,8 +1,9 @@
 # -*- coding: utf-8 -*-
 # date: 2018-11-29 20:07
+import torch
 import torch.nn as nn
 
-from .functional import clones
+from .functional import clones, checkpoint_block
 from .layer_norm import LayerNorm
 
 
@@ -18,11 +19,25 @@ class Encoder(nn.Module):
         super(Encoder, self).__init__()
         self.layers = clones(layer, n)
         self.norm = LayerNorm(layer.size)
+        self.checkpoint_layers = 0
+
+    def set_checkpoint_layers(self, n):
+        """
+        Recompute the activations of the first n layers in backward instead of keeping them.
+        """
+        self.checkpoint_layers = n
+        for i, layer in enumerate(self.layers):
+            for m in layer.modules():
+                if hasattr(m, 'keep_attn'):
+                    m.keep_attn = i >= n
 
     def forward(self, x, x_mask):
         """
         Pass the input (and mask) through each layer in turn.
         """
-        for layer in self.layers:
-            x = layer(x, x_mask)
+        for i, layer in enumerate(self.layers):
+            if i < self.checkpoint_layers and self.training and torch.is_grad_enabled():
+                x = checkpoint_block(layer, x, x_mask)
+            else:
+                x = layer(x, x_mask)
         return self.norm(x)
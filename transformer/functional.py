@@ -7,6 +7,12 @@ import numpy
 import torch
 import torch.nn as nn
 from torch.nn.functional import softmax
+from torch.utils.checkpoint import checkpoint
+
+try:
+    from torch.nn.functional import scaled_dot_product_attention
+except ImportError:  # torch < 2.0
+    scaled_dot_product_attention = None
 
 
 def clones(module, n):
@@ -17,6 +23,32 @@ def clones(module, n):
     return nn.ModuleList([deepcopy(module) for _ in range(n)])
 
 
+def checkpoint_block(block, *inputs):
+    """
+    Run block with activation checkpointing, its activations are recomputed in backward.
+    BatchNorm running stats are only updated by the first forward, not by the recomputation.
+    """
+    calls = []
+
+    def run(*inputs):
+        if not calls:
+            calls.append(1)
+            return block(*inputs)
+        norms = [m for m in block.modules() if isinstance(m, nn.modules.batchnorm._BatchNorm) and m.training]
+        state = [(m.momentum, m.num_batches_tracked.clone() if m.num_batches_tracked is not None else None) for m in norms]
+        for m in norms:
+            m.momentum = 0.0
+        try:
+            return block(*inputs)
+        finally:
+            for m, (momentum, tracked) in zip(norms, state):
+                m.momentum = momentum
+                if tracked is not None:
+                    m.num_batches_tracked.copy_(tracked)
+
+    return checkpoint(run, *inputs, use_reentrant=False)
+
+
 def subsequent_mask(size):
     """
     Mask out subsequent positions.
@@ -26,6 +58,29 @@ def subsequent_mask(size):
     return torch.from_numpy(mask) == 0
 
 
+_mask_cache = {}
+
+
+def cached_subsequent_mask(size, device, dtype=torch.bool):
+    """
+    subsequent_mask built once per (size, device, dtype), shaped [1, size, size] so it broadcasts over the batch.
+    """
+    key = ('subsequent', size, torch.device(device), dtype)
+    if key not in _mask_cache:
+        _mask_cache[key] = torch.ones((1, size, size), device=device).tril_().to(dtype)
+    return _mask_cache[key]
+
+
+def cached_src_mask(size, device, dtype=torch.bool):
+    """
+    All-visible source mask built once per (size, device, dtype), shaped [1, 1, size] so it broadcasts over the batch.
+    """
+    key = ('src', size, torch.device(device), dtype)
+    if key not in _mask_cache:
+        _mask_cache[key] = torch.ones((1, 1, size), device=device).to(dtype)
+    return _mask_cache[key]
+
+
 def attention(query, key, value, mask=None, dropout=None):
     """
     Compute 'Scaled Dot Product Attention'
@@ -38,3 +93,46 @@ def attention(query, key, value, mask=None, dropout=None):
     if dropout is not None:
         p_attn = dropout(p_attn)
     return torch.matmul(p_attn, value), p_attn
+
+
+def sdpa_attention(query, key, value, mask=None, dropout=None):
+    """
+    Scaled Dot Product Attention through the fused torch kernel, no attention probabilities are kept
+    """
+    if mask is not None and mask.dtype != torch.bool:
+        mask = mask != 0
+    dropout_p = dropout.p if dropout is not None and dropout.training else 0.0
+    return scaled_dot_product_attention(query, key, value, attn_mask=mask, dropout_p=dropout_p), None
+
+
+def chunked_attention(query, key, value, mask=None, dropout=None, chunk_size=1024):
+    """
+    Reference attention over slices of the batch, only chunk_size score tensors are alive at once
+    """
+    outputs = []
+    for i in range(0, query.size(0), chunk_size):
+        chunk_mask = mask
+        if mask is not None and mask.size(0) > 1:
+            chunk_mask = mask[i:i + chunk_size]
+        x, _ = attention(query[i:i + chunk_size], key[i:i + chunk_size], value[i:i + chunk_size],
+                         mask=chunk_mask, dropout=dropout)
+        outputs.append(x)
+    return torch.cat(outputs, dim=0), None
+
+
+def get_attention(backend='reference'):
+    """
+    Pick an attention implementation: 'reference', 'sdpa', 'chunked' or 'auto' (sdpa when available)
+    """
+    if backend == 'auto':
+        backend = 'reference' if scaled_dot_product_attention is None else 'sdpa'
+    if backend == 'reference':
+        return attention
+    elif backend == 'sdpa':
+        if scaled_dot_product_attention is None:
+            raise RuntimeError('scaled_dot_product_attention needs torch >= 2.0')
+        return sdpa_attention
+    elif backend == 'chunked':
+        return chunked_attention
+    else:
+        raise ValueError('unknown attention backend {:s}'.format(str(backend)))
@@ -1,8 +1,11 @@
 # -*- coding: utf-8 -*-
 # date: 2018-11-29 20:14
+import math
+
 import torch
 
 import torch.nn as nn
+from torch.nn.functional import layer_norm
 
 
 class LayerNorm(nn.Module):
@@ -10,13 +13,29 @@ class LayerNorm(nn.Module):
     Construct a layernorm module (See citation for details).
     """
 
-    def __init__(self, features, eps=1e-6):
+    def __init__(self, features, eps=1e-6, fused=False):
         super(LayerNorm, self).__init__()
         self.a_2 = nn.Parameter(torch.ones(features))
         self.b_2 = nn.Parameter(torch.zeros(features))
         self.eps = eps
+        self.fused = fused
 
     def forward(self, x):
+        if self.fused:
+            # layer_norm divides by sqrt(biased var + eps'), rescaling the weight by sqrt((n-1)/n) and using
+            # eps' = eps**2 * (n-1)/n turns that into (x - mean) / sqrt(unbiased var + eps**2) ~ (x - mean) / (std + eps)
+            n = x.size(-1)
+            return layer_norm(x, (n,), self.a_2 * math.sqrt((n - 1) / n), self.b_2, self.eps ** 2 * (n - 1) / n)
         mean = x.mean(dim=-1, keepdim=True)
         std = x.std(dim=-1, keepdim=True)
         return self.a_2 * (x - mean) / (std + self.eps) + self.b_2
+
+
+def set_fused_norm(model, fused=True):
+    """
+    Switch every LayerNorm inside model between the fused and the reference formula, weights are shared.
+    """
+    for module in model.modules():
+        if isinstance(module, LayerNorm):
+            module.fused = fused
+    return model
@@ -2,14 +2,15 @@
 # date: 2018-11-30 16:35
 import torch.nn as nn
 
-from .functional import clones, attention
+from .functional import clones, get_attention
 
 
 class MultiHeadAttention(nn.Module):
 
-    def __init__(self, h, d_model, dropout=0.1): # 8,512,0.1
+    def __init__(self, h, d_model, dropout=0.1, backend='reference'): # 8,512,0.1
         """
         Take in model size and number of heads.
+        backend selects the attention kernel, see functional.get_attention.
         """
         super(MultiHeadAttention, self).__init__()
         assert d_model % h == 0
@@ -18,7 +19,11 @@ class MultiHeadAttention(nn.Module):
         self.h = h
         self.linears = clones(nn.Linear(d_model, d_model), 4)
         self.attn = None
+        # False in checkpointed layers, the stored probabilities would keep [nbatches, h, T, S] alive per layer
+        self.keep_attn = True
         self.dropout = nn.Dropout(p=dropout)
+        self.backend = backend
+        self.attention = get_attention(backend)
 
     def forward(self, query, key, value, mask=None): # x, x, x, mask
         """
@@ -32,7 +37,9 @@ class MultiHeadAttention(nn.Module):
         query, key, value = [l(x).view(nbatches, -1, self.h, self.d_k).transpose(1, 2) for l, x in
                              zip(self.linears, (query, key, value))]
         # 2) Apply attention on all the projected vectors in batch.
-        x, self.attn = attention(query, key, value, mask=mask, dropout=self.dropout)
+        # fused backends do not materialize p_attn, self.attn stays None for them
+        x, attn = self.attention(query, key, value, mask=mask, dropout=self.dropout)
+        self.attn = attn if self.keep_attn or not self.training else None
         # 3) "Concat" using a view and apply a final linear.
         x = x.transpose(1, 2).contiguous().view(nbatches, -1, self.h * self.d_k)
         return self.linears[-1](x)
@@ -6,6 +6,7 @@ import torch
 import numpy as np
 import networkx as nx
 import logging
+import contextlib
 
 from torch.utils.data import Dataset
 from tqdm import tqdm
@@ -78,34 +79,169 @@ def interpolate_traj(traj, num_interp=4):
 
 
 def compute_col(predicted_traj, predicted_trajs_all, thres=0.2):
-    ph = predicted_traj.shape[0]
-    num_interp = 4
+    # [12, 2] x [num_person, 12, 2] -> [56] bool, the agent itself (distance 0 at the first step) is skipped
     assert predicted_trajs_all.shape[0] > 1
-
-    dense_all = interpolate_traj(predicted_trajs_all, num_interp) 
-    dense_ego = interpolate_traj(predicted_traj[None, :], num_interp) 
-    distances = np.linalg.norm(dense_all - dense_ego, axis=-1) 
-    mask = distances[:, 0] > 0  
-    return (distances[mask].min(axis=0) < thres) 
+    mask_nei = np.ones((1, predicted_trajs_all.shape[0]), dtype=bool)
+    return compute_col_batch(predicted_traj[None, None], predicted_trajs_all[None], mask_nei, thres)[0, 0]
 
 def compute_col_pred(predicted_traj, predicted_trajs_all, mask_nei=[], thres=0.2):
-    ph = predicted_traj.shape[0]
-    num_interp = 4
+    # compute_col restricted to the neighbors selected by mask_nei (bool mask or indices)
     assert predicted_trajs_all.shape[0] > 1
+    mask = np.zeros((1, predicted_trajs_all.shape[0]), dtype=bool)
+    mask[0, mask_nei] = True
+    return compute_col_batch(predicted_traj[None, None], predicted_trajs_all[None], mask, thres)[0, 0]
+
+def interpolate_trajs(trajs, num_interp=4):
+    # interpolate_traj over any leading dims, [..., T, 2] -> [..., (T-1)*(num_interp+1)+1, 2] float64
+    # same arithmetic as interpolate_traj: weights in the input dtype, result stored as float64
+    ratio = np.arange(1, num_interp + 2) / (num_interp + 1) # [num_interp+1]
+    dtype = trajs.dtype if np.issubdtype(trajs.dtype, np.floating) else np.float64
+    start, end = trajs[..., :-1, None, :], trajs[..., 1:, None, :] # [..., T-1, 1, 2]
+    dense = start * (1 - ratio[:, None]).astype(dtype) + end * ratio[:, None].astype(dtype) # [..., T-1, num_interp+1, 2]
+    dense = dense.reshape(trajs.shape[:-2] + (-1, 2))
+    return np.concatenate((trajs[..., :1, :], dense), axis=-2).astype(np.float64)
+
+
+def swept_min_dist2(rel, num_interp=4):
+    """
+    Exact minimum squared distance of two agents moving linearly between samples.
+    rel: [..., T, 2] position of the other agent relative to the ego one -> [..., (T-1)*(num_interp+1)+1]
+    Entry 0 is the distance at the first sample, entry j the minimum over the j-th sub-interval of the
+    interpolate_traj grid, so the layout matches the interpolated check. num_interp=0 gives one entry per interval.
+    """
+    r0 = rel[..., :-1, :] # [..., T-1, 2]
+    dr = rel[..., 1:, :] - r0
+    # |r0 + s*dr|^2 = c + 2*b*s + a*s^2, minimized over each sub-interval [s0, s1] of s in [0, 1]
+    a = (dr ** 2).sum(axis=-1)[..., None] # [..., T-1, 1]
+    b = (r0 * dr).sum(axis=-1)[..., None]
+    c = (r0 ** 2).sum(axis=-1)[..., None]
+    edges = np.arange(num_interp + 2) / (num_interp + 1)
+    s_vertex = np.divide(-b, a, out=np.zeros_like(b), where=a > 0) # a == 0: constant distance
+    s = np.clip(s_vertex, edges[:-1], edges[1:]) # [..., T-1, num_interp+1]
+    dist2 = c + s * (2 * b + a * s)
+    dist2 = dist2.reshape(dist2.shape[:-2] + (-1,))
+    return np.concatenate((c[..., 0, :], dist2), axis=-1)
+
+
+def _index_ranges(lo, hi):
+    # concatenated aranges [lo_i, hi_i) -> (i, position) pairs
+    counts = np.maximum(hi - lo, 0)
+    rows = np.repeat(np.arange(len(lo)), counts)
+    positions = np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts) + np.repeat(lo, counts)
+    return rows, positions
+
+
+def sweep_and_prune(box_a, box_b, pad):
+    """
+    Pairs of axis aligned boxes that are within pad of each other along x and y, found by sorting along x
+    instead of testing every pair. box_a: [A, 4]  box_b: [B, 4] as (xmin, ymin, xmax, ymax) -> (ia, ib) index arrays
+    """
+    # b starts inside [a.xmin, a.xmax + pad], or a starts inside (b.xmin, b.xmax + pad], each pair is found once
+    order_b = np.argsort(box_b[:, 0], kind='stable')
+    xmin_b = box_b[order_b, 0]
+    ia1, pos = _index_ranges(np.searchsorted(xmin_b, box_a[:, 0], 'left'),
+                             np.searchsorted(xmin_b, box_a[:, 2] + pad, 'right'))
+    ib1 = order_b[pos]
+    order_a = np.argsort(box_a[:, 0], kind='stable')
+    xmin_a = box_a[order_a, 0]
+    ib2, pos = _index_ranges(np.searchsorted(xmin_a, box_b[:, 0], 'right'),
+                             np.searchsorted(xmin_a, box_b[:, 2] + pad, 'right'))
+    ia2 = order_a[pos]
+    ia, ib = np.concatenate((ia1, ia2)), np.concatenate((ib1, ib2))
+    overlap_y = (box_b[ib, 1] <= box_a[ia, 3] + pad) & (box_a[ia, 1] <= box_b[ib, 3] + pad)
+    return ia[overlap_y], ib[overlap_y]
+
+
+def _pair_distances(ego, other, thres, num_interp, exact):
+    # distance measure of every pair [..., 56] and the value it has to stay below for a collision
+    if exact:
+        # squared distances, min(d) < thres <=> min(d^2) < thres^2 and saves the sqrt of every pair
+        return swept_min_dist2(other - ego, num_interp), thres ** 2
+    # the interpolated point check, in the arithmetic of interpolate_traj + compute_col
+    distances = np.linalg.norm(interpolate_trajs(other, num_interp) - interpolate_trajs(ego, num_interp), axis=-1)
+    return distances, thres
+
+
+def compute_col_batch(ego_trajs, other_trajs, mask_nei, thres=0.2, num_interp=4, exact=False, broad_phase=True):
+    """
+    compute_col_pred for every ego agent and sample at once.
+    ego_trajs: [K, N, T, 2]  other_trajs: [K or 1, M, T, 2]  mask_nei: [N, M] -> [K, N, (T-1)*5+1] bool
+    Neighbors outside mask_nei or at distance 0 in the first step (the agent itself) are ignored.
+    exact=False compares the interpolated points, the published COL metric.
+    exact=True flags a step when the agents come closer than thres anywhere on the linear segment leading to it,
+    a superset of the interpolated flags.
+    broad_phase=True first drops pairs whose trajectory bounding boxes, padded by thres, do not overlap;
+    the flags are the same as with the all pairs check.
+    """
+    if not broad_phase:
+        distances, limit = _pair_distances(ego_trajs[:, :, None], other_trajs[:, None], thres, num_interp, exact) # [K, N, M, 56]
+        valid = mask_nei[None] & (distances[..., 0] > 0) # [K, N, M]
+        distances[~np.broadcast_to(valid, distances.shape[:3])] = np.inf
+        return distances.min(axis=2) < limit
+
+    K, N, T = ego_trajs.shape[:3]
+    M = other_trajs.shape[1]
+    box_ego = np.concatenate((ego_trajs.min(axis=2), ego_trajs.max(axis=2)), axis=-1) # [K, N, 4]
+    box_other = np.concatenate((other_trajs.min(axis=2), other_trajs.max(axis=2)), axis=-1) # [K or 1, M, 4]
+    box_other = np.broadcast_to(box_other, (K, M, 4))
+    # shift sample k by k*span along x so one sweep handles all samples without mixing them
+    span = max(box_ego[..., 2].max(), box_other[..., 2].max()) - min(box_ego[..., 0].min(), box_other[..., 0].min())
+    shift = (np.arange(K) * (span + 4 * thres + 1))[:, None, None] * np.array([1, 0, 1, 0])
+    # the pad is slightly enlarged so the shifted coordinates can never prune a pair the exact check would flag
+    ia, ib = sweep_and_prune((box_ego + shift).reshape(-1, 4), (box_other + shift).reshape(-1, 4), thres * (1 + 1e-6) + 1e-9)
+    k, n, m = ia // N, ia % N, ib % M
+    keep = mask_nei[n, m]
+    k, n, m, ia = k[keep], n[keep], m[keep], ia[keep]
+
+    coll = np.zeros((K * N, (T - 1) * (num_interp + 1) + 1), dtype=bool)
+    if len(ia) == 0:
+        return coll.reshape(K, N, -1)
+    other = other_trajs[k if other_trajs.shape[0] > 1 else 0, m] # [P, T, 2]
+    distances, limit = _pair_distances(ego_trajs[k, n], other, thres, num_interp, exact) # [P, 56]
+    hit = (distances < limit) & (distances[:, :1] > 0)
+    # any over the candidate neighbors of every (sample, ego agent)
+    order = np.argsort(ia, kind='stable')
+    rows, starts = np.unique(ia[order], return_index=True)
+    coll[rows] = np.logical_or.reduceat(hit[order], starts, axis=0)
+    return coll.reshape(K, N, -1)
+
+
+def evaluate_ksteps(V_pred_rel_to_abs_ksteps, V_y_rel_to_abs, mask_pred, compute_col_truth=False, ks=None, exact_col=False,
+                    thres=0.2, num_interp=4):
+    """
+    Best-of-K ADE/FDE and collision curves of one scene, the batched replacement of the per agent and sample loops.
+    V_pred_rel_to_abs_ksteps: [KSTEPS, 12, num_object, 2]  V_y_rel_to_abs: [12, num_object, 2]  mask_pred: [num_object, num_object]
+    Returns per agent ade, fde and collision rate lists and [num_object*KSTEPS, 56] joint, cross and
+    ground-truth collision rows (agent major, the ground-truth rows once per agent).
+    With ks, e.g. [1, 5, 10, 20], returns {K: that tuple for the first K samples}; distances and collisions
+    are computed once for all samples and only reduced per prefix.
+    exact_col switches the collision rows to the swept-segment check of compute_col_batch(exact=True), thres and
+    num_interp are passed on to it as well (with num_interp != 4 the rows are not 56 wide).
+    """
+    error = np.linalg.norm(V_pred_rel_to_abs_ksteps - V_y_rel_to_abs[None], axis=-1) # [KSTEPS, 12, num_object]
+
+    pred_trajs = V_pred_rel_to_abs_ksteps.transpose(0, 2, 1, 3) # [KSTEPS, num_object, 12, 2]
+    target_trajs = V_y_rel_to_abs.transpose(1, 0, 2)[None] # [1, num_object, 12, 2]
+    # collisions are per sample, so the rows of the first K samples are those of a K sample run
+    col_joint = compute_col_batch(pred_trajs, pred_trajs, mask_pred, thres, num_interp, exact_col) # [KSTEPS, num_object, 56], between predictions
+    col_cross = compute_col_batch(pred_trajs, target_trajs, mask_pred, thres, num_interp, exact_col) # prediction x ground-truth
+    if compute_col_truth:
+        col_truth = compute_col_batch(target_trajs, target_trajs, mask_pred, thres, num_interp, exact_col)[0].astype(np.float64) # [num_object, 56], between ground-truth
+    else:
+        col_truth = None
 
-    dense_all = interpolate_traj(predicted_trajs_all, num_interp)
-    dense_ego = interpolate_traj(predicted_traj[None, :], num_interp)
-    distances = np.linalg.norm(dense_all - dense_ego, axis=-1)  
-    distances = distances[mask_nei,:]
+    def prefix(K):
+        ade_ = error[:K].mean(axis=1).min(axis=0) # [num_object]
+        fde_ = error[:K, -1].min(axis=0)
+        coll_ = col_joint[:K].any(axis=-1).mean(axis=0) # [num_object]
+        joint = col_joint[:K].transpose(1, 0, 2).reshape(-1, col_joint.shape[-1]).astype(np.float64) # [num_object*K, 56]
+        cross = col_cross[:K].transpose(1, 0, 2).reshape(-1, col_cross.shape[-1]).astype(np.float64)
+        return list(ade_), list(fde_), list(coll_), joint, cross, col_truth
 
-    mask = distances[:, 0] > 0 
+    if ks is None:
+        return prefix(V_pred_rel_to_abs_ksteps.shape[0])
+    return {K: prefix(K) for K in ks}
 
-    if (distances[mask].shape[0]==1):
-        return (distances[mask][0] < thres)
-    elif(distances[mask].shape[0]>1):
-        return (distances[mask].min(axis=0) < thres)
-    else:
-        return np.repeat(False, ((ph-1)*5+1))
 
 def adjConcat(a, b):
 
@@ -122,6 +258,44 @@ def adjConcat(a, b):
     return result
 
 
+# agent axes of the TrajectoryDataset fields, in __getitem__ order
+SCENE_AGENT_DIMS = [(0,), (0,), (0,), (0,), (0,), (0,), (1,), (1, 2), (1,), (1, 2), (0,)]
+
+def collate_scenes(batch):
+    """
+    DataLoader collate_fn that pads scenes with different agent counts to the largest one.
+    Padded agents get zero features and zero adjacency rows/columns, so the graph convolution
+    never mixes them into real agents. Returns the stacked fields plus agent_mask [bs, num_person].
+    """
+    num_person = max(item[0].size(0) for item in batch)
+    out = []
+    for field in range(len(batch[0])):
+        padded = []
+        for item in batch:
+            tensor = item[field]
+            pad = []
+            for dim in reversed(range(tensor.dim())):
+                size = num_person - tensor.size(dim) if dim in SCENE_AGENT_DIMS[field] else 0
+                pad += [0, size]
+            padded.append(torch.nn.functional.pad(tensor, pad))
+        out.append(torch.stack(padded, dim=0))
+    agent_mask = torch.zeros(len(batch), num_person).bool()
+    for idx, item in enumerate(batch):
+        agent_mask[idx, :item[0].size(0)] = True
+    out.append(agent_mask)
+    return out
+
+
+def cpu_autocast(enabled=False):
+    """
+    bf16 autocast on CPU for the st_gcn and transformer blocks, a no-op when disabled.
+    Outputs come back as bf16, cast them with .float() before the loss or sampling.
+    """
+    if enabled:
+        return torch.autocast('cpu', dtype=torch.bfloat16)
+    return contextlib.nullcontext()
+
+
 def setup_logging(name, output_dir, console=True):
     log_format = logging.Formatter("%(asctime)s : %(message)s")
     logger = logging.getLogger(name)